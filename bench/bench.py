@@ -0,0 +1,228 @@
+"""Measure each ingest stage on a directory of .zst dumps, and save the results
+
+Stages, each on the same files:
+
+  read        zst.read_lines_zst and zst.read_line_batches_zst
+  decode      extract.make_decoder, for each JSON engine installed
+  insert      executemany of the decoded rows into a new SQLite file
+  load-queue  load-queue.py end to end, with per-stage throughput
+              from its --metrics
+  duckdb      duckdb/reddit_to_duckdb.py end to end (if duckdb is installed)
+
+Every run appends one JSON line to --results with the git commit, the
+machine and the numbers, so runs can be compared across changes
+(--compare prints them as a table).  Make data with make_data.py.
+"""
+
+import argparse
+from datetime import datetime
+import glob
+import importlib.util
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import extract
+import zst
+
+
+# The comment columns of load-queue.py --thin, without its id prefix
+COLUMNS = [
+    ('subreddit', 'TEXT'),
+    ('author', 'TEXT'),
+    ('id', 'TEXT'),
+    ('link_id', 'TEXT'),
+    ('created_utc', 'INTEGER'),
+    ('score', 'INTEGER'),
+    ]
+
+
+def result(name, seconds, lines, comp_bytes=None, decomp_bytes=None, **extra):
+    """One stage result, with rates"""
+    r = dict(stage=name, seconds=seconds, lines=lines, lines_per_s=lines / seconds)
+    if comp_bytes is not None:
+        r['comp_mb_per_s'] = comp_bytes / 2**20 / seconds
+    if decomp_bytes is not None:
+        r['decomp_mb_per_s'] = decomp_bytes / 2**20 / seconds
+    r.update(extra)
+    print(f"{name:24s} {seconds:7.2f} s {r['lines_per_s']:12,.0f} lines/s"
+          + (f" {r['comp_mb_per_s']:8.1f} MB/s compressed" if comp_bytes is not None else '')
+          + (f" {r['decomp_mb_per_s']:8.1f} MB/s JSON" if decomp_bytes is not None else ''),
+          flush=True)
+    return r
+
+
+def bench_read(files, comp_bytes):
+    results = [ ]
+    start = time.time()
+    lines = decomp_bytes = 0
+    for file_ in files:
+        for line, _ in zst.read_lines_zst(file_):
+            lines += 1
+            decomp_bytes += len(line) + 1   # chars, not bytes: about the same
+    results.append(result('read: read_lines_zst', time.time() - start, lines, comp_bytes, decomp_bytes))
+    start = time.time()
+    lines = decomp_bytes = 0
+    for file_ in files:
+        for batch, _ in zst.read_line_batches_zst(file_):
+            lines += len(batch)
+            decomp_bytes += sum(map(len, batch)) + len(batch)
+    results.append(result('read: line batches', time.time() - start, lines, comp_bytes, decomp_bytes))
+    return results, decomp_bytes
+
+
+def bench_decode(lines, decomp_bytes):
+    """Decode lines with each engine, return the results and the rows"""
+    results = [ ]
+    engines = [ 'orjson' ] + ([ 'simdjson' ] if extract.simdjson is not None else [ ])
+    for engine in engines:
+        decode_line = extract.make_decoder(COLUMNS, engine)
+        rows = [ ]
+        bad = 0
+        start = time.time()
+        for line in lines:
+            try:
+                rows.append(decode_line(line))
+            except extract.BAD_LINE:
+                bad += 1
+        results.append(result(f'decode: {engine}', time.time() - start, len(lines), None, decomp_bytes, bad=bad))
+    return results, rows
+
+
+def bench_insert(rows, tmpdir, chunk=100000):
+    conn = sqlite3.connect(os.path.join(tmpdir, 'insert.sqlite3'))
+    conn.execute('PRAGMA page_size = 16384;')
+    conn.execute('PRAGMA journal_mode = wal;')
+    conn.execute(f'CREATE TABLE comments ({", ".join(" ".join(col) for col in COLUMNS)})')
+    insert = f'INSERT INTO comments VALUES ({",".join(["?"]*len(COLUMNS))})'
+    start = time.time()
+    for i in range(0, len(rows), chunk):
+        conn.executemany(insert, rows[i:i+chunk])
+        conn.commit()
+    seconds = time.time() - start
+    conn.close()
+    return [ result('insert: sqlite', seconds, len(rows)) ]
+
+
+def bench_load_queue(files, comp_bytes, decomp_bytes, lines, tmpdir, load_args):
+    """Run load-queue.py on the comment files, per-stage rates from its metrics"""
+    db = os.path.join(tmpdir, 'load-queue.sqlite3')
+    metrics = os.path.join(tmpdir, 'metrics.jsonl')
+    cmd = [ sys.executable, os.path.join(ROOT, 'load-queue.py'), '--comments',
+            f'--metrics={metrics}', db ] + load_args + files
+    start = time.time()
+    subprocess.run(cmd, cwd=tmpdir, check=True, stdout=subprocess.DEVNULL)
+    seconds = time.time() - start
+    with open(metrics) as f:
+        final = [ json.loads(line) for line in f ][-1]
+    # Per process: lines / time spent on chunks (not waiting for queues)
+    stages = { stage: x['lines'] / x['busy_s'] for stage, x in final['stages'].items() if x['busy_s'] }
+    results = [ result('load-queue.py', seconds, lines, comp_bytes, decomp_bytes,
+                       args=load_args, per_process_lines_per_s=stages) ]
+    for stage, rate in stages.items():
+        print(f"{'  per ' + stage + ' process':24s} {'':9s} {rate:12,.0f} lines/s")
+    return results
+
+
+def bench_duckdb(files, comp_bytes, decomp_bytes, lines, tmpdir):
+    cmd = [ sys.executable, os.path.join(ROOT, 'duckdb', 'reddit_to_duckdb.py'),
+            f'--cpus={os.cpu_count()}', os.path.join(tmpdir, 'reddit.duckdb') ] + files
+    start = time.time()
+    subprocess.run(cmd, cwd=tmpdir, check=True, stdout=subprocess.DEVNULL)
+    return [ result('duckdb', time.time() - start, lines, comp_bytes, decomp_bytes) ]
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results_file, n):
+    """Print the lines/s of each stage over the last n runs"""
+    with open(results_file) as f:
+        runs = [ json.loads(line) for line in f ][-n:]
+    stages = list(dict.fromkeys(r['stage'] for run in runs for r in run['results']))
+    print(f"{'':24s} " + ' '.join(f"{run['git'] or '?':>14.14s}" for run in runs))
+    print(f"{'':24s} " + ' '.join(f"{run['time'][5:16]:>14s}" for run in runs))
+    for stage in stages:
+        rates = [ { r['stage']: r['lines_per_s'] for r in run['results'] }.get(stage) for run in runs ]
+        print(f"{stage:24s} " + ' '.join(f"{x:14,.0f}" if x else f"{'-':>14s}" for x in rates))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('data', nargs='?', help="Directory of *_comments.zst files")
+    parser.add_argument('--stages', default='read,decode,insert,load-queue,duckdb')
+    parser.add_argument('--load-args', default='--readers=2 --decoders=4',
+                        help="Arguments for load-queue.py (default: %(default)s)")
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl'),
+                        help="Append results here (default: %(default)s)")
+    parser.add_argument('--label', help="Note to save with the results")
+    parser.add_argument('--compare', type=int, metavar='N', help="Only print the last N saved runs")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.results, args.compare)
+        return
+    if not args.data:
+        parser.error("data directory needed")
+
+    stages = args.stages.split(',')
+    files = sorted(glob.glob(os.path.join(os.path.abspath(args.data), '*_comments.zst')))
+    comp_bytes = sum(os.stat(f).st_size for f in files)
+    print(f"{len(files)} files, {comp_bytes/2**20:.1f} MB compressed", flush=True)
+
+    results = [ ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results_read, decomp_bytes = bench_read(files, comp_bytes)
+        if 'read' in stages:
+            results.extend(results_read)
+        lines = [ line for file_ in files for batch, _ in zst.read_line_batches_zst(file_) for line in batch ]
+        n_lines = len(lines)
+        if 'decode' in stages or 'insert' in stages:
+            results_decode, rows = bench_decode(lines, decomp_bytes)
+            if 'decode' in stages:
+                results.extend(results_decode)
+            del lines
+            if 'insert' in stages:
+                results.extend(bench_insert(rows, tmpdir))
+            del rows
+        if 'load-queue' in stages:
+            results.extend(bench_load_queue(files, comp_bytes, decomp_bytes, n_lines, tmpdir, args.load_args.split()))
+        if 'duckdb' in stages:
+            if importlib.util.find_spec('duckdb') is None:
+                print("duckdb: not installed, skipped")
+            else:
+                results.extend(bench_duckdb(files, comp_bytes, decomp_bytes, n_lines, tmpdir))
+
+    run = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'git': git_version(),
+        'label': args.label,
+        'host': platform.node(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'data': os.path.abspath(args.data),
+        'files': len(files),
+        'comp_bytes': comp_bytes,
+        'decomp_bytes': decomp_bytes,
+        'lines': n_lines,
+        'results': results,
+        }
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    print(f"Saved to {args.results}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Generate synthetic Reddit dumps: SUB_comments.zst and SUB_submissions.zst
+
+The files look like the pushshift per-subreddit dumps for the purposes
+of load-queue.py and duckdb/reddit_to_duckdb.py: one JSON object per
+line, sorted by created_utc, with the fields those read plus unused
+ones of realistic size.  Subreddit sizes and author activity follow a
+Zipf distribution, bodies have a long-tailed length and mix ASCII with
+multi-byte UTF-8, and a small fraction of lines is malformed.  The
+output is the same for the same arguments.
+"""
+
+import argparse
+import json
+import os
+import random
+import zlib
+
+import zstandard
+
+
+WORDS = ("the a of to and is that it for you this on with but not are be have just like "
+         "what so if they was people think would can more about all one no your there").split()
+# Multi-byte UTF-8 of 2, 3 and 4 bytes per character
+WORDS_UTF8 = ("héllo wörld naïve café über señor straße ☃ ✓ → — “quoted” "
+              "日本語 中文 한국어 русский ελληνικά 😀 🎉 👍 🤔").split()
+MAX_ID = 36**7
+
+
+def b36(n):
+    """Integer -> base 36 reddit id"""
+    s = ''
+    while True:
+        n, r = divmod(n, 36)
+        s = '0123456789abcdefghijklmnopqrstuvwxyz'[r] + s
+        if n == 0:
+            return s
+
+
+def zipf_sizes(total, n, s, rng):
+    """Split total into n sizes with weight 1/rank**s, shuffled a bit"""
+    weights = [ 1 / (i+1)**s for i in range(n) ]
+    norm = sum(weights)
+    return [ max(1, int(total * w / norm * rng.uniform(.8, 1.2))) for w in weights ]
+
+
+def text(rng, mean_words):
+    """A body with a long-tailed number of words, some of them multi-byte"""
+    n = min(int(rng.lognormvariate(0, 1.2) * mean_words) + 1, 5000)
+    words = rng.choices(WORDS, k=n)
+    for i in rng.sample(range(n), k=n//8):
+        words[i] = rng.choice(WORDS_UTF8)
+    return ' '.join(words)
+
+
+def comment(rng, sub, id_, t, authors, links):
+    return {
+        'all_awardings': [ ],
+        'associated_award': None,
+        'author': rng.choice(authors),
+        'author_flair_background_color': None,
+        'author_flair_css_class': None,
+        'author_flair_richtext': [ ],
+        'author_flair_text': rng.choice([None, None, None, 'flair ✓', 'Verified']),
+        'author_fullname': 't2_' + b36(rng.randrange(MAX_ID)),
+        'body': text(rng, 30),
+        'collapsed': False,
+        'controversiality': int(rng.random() < .05),
+        'created_utc': t,
+        'distinguished': rng.choice([None]*50 + ['moderator']),
+        'edited': False,
+        'gilded': int(rng.random() < .002),
+        'gildings': { },
+        'id': id_,
+        'is_submitter': rng.random() < .1,
+        'link_id': 't3_' + rng.choice(links),
+        'locked': False,
+        'no_follow': True,
+        'parent_id': rng.choice(['t3_' + rng.choice(links), 't1_' + b36(rng.randrange(MAX_ID))]),
+        'permalink': f'/r/{sub}/comments/{id_}/',
+        'retrieved_on': t + 3600,
+        'score': int(rng.paretovariate(1.5)) - rng.randrange(3),
+        'send_replies': True,
+        'stickied': False,
+        'subreddit': sub,
+        'subreddit_id': 't5_' + b36(zlib.crc32(sub.encode())),
+        'total_awards_received': 0,
+        }
+
+
+def submission(rng, sub, id_, t, authors):
+    is_self = rng.random() < .6
+    return {
+        'all_awardings': [ ],
+        'author': rng.choice(authors),
+        'author_flair_text': rng.choice([None, None, None, 'flair ✓']),
+        'created_utc': t,
+        'domain': f'self.{sub}' if is_self else rng.choice(['i.redd.it', 'youtube.com', 'nytimes.com']),
+        'hidden': False,
+        'id': id_,
+        'is_self': is_self,
+        'media': None,
+        'num_comments': int(rng.paretovariate(1.2)),
+        'over_18': rng.random() < .02,
+        'permalink': f'/r/{sub}/comments/{id_}/',
+        'retrieved_on': t + 3600,
+        'score': int(rng.paretovariate(1.3)),
+        'selftext': text(rng, 80) if is_self else '',
+        'subreddit': sub,
+        'subreddit_id': 't5_' + b36(zlib.crc32(sub.encode())),
+        'title': text(rng, 10)[:300],
+        'url': f'https://www.reddit.com/r/{sub}/comments/{id_}/' if is_self else f'https://example.com/{id_}',
+        }
+
+
+def malformed(rng, line):
+    """One of the kinds of broken lines seen in the dumps"""
+    kind = rng.randrange(3)
+    if kind == 0:
+        return line[:len(line)//2]              # truncated
+    if kind == 1:
+        return b'{"id": "' + line[8:40] + b'}'  # invalid JSON
+    return b'{"body": "no id or subreddit"}'    # missing fields
+
+
+def write_file(name, objs, rng, args):
+    """Compress the lines of objs into name, in frames of --frame-mb if given"""
+    params = zstandard.ZstdCompressionParameters.from_level(
+        args.level, window_log=args.window_log, enable_ldm=args.window_log > 27)
+    cctx = zstandard.ZstdCompressor(compression_params=params)
+    n_lines = frame_bytes = 0
+    with open(name, 'wb') as f, cctx.stream_writer(f) as writer:
+        for obj in objs:
+            line = json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+            if rng.random() < args.bad:
+                line = malformed(rng, line)
+            writer.write(line + b'\n')
+            n_lines += 1
+            frame_bytes += len(line) + 1
+            if args.frame_mb and frame_bytes >= args.frame_mb * 2**20:
+                writer.flush(zstandard.FLUSH_FRAME)
+                frame_bytes = 0
+    return n_lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('outdir')
+    parser.add_argument('--comments', type=int, default=200000, help="Total comments over all subreddits")
+    parser.add_argument('--subs', type=int, default=20, help="Number of subreddits")
+    parser.add_argument('--skew', type=float, default=1.2, help="Zipf exponent of subreddit sizes")
+    parser.add_argument('--bad', type=float, default=1e-4, help="Fraction of malformed lines")
+    parser.add_argument('--level', type=int, default=3, help="zstd level")
+    parser.add_argument('--window-log', type=int, default=27, help="zstd window log (the dumps use 31, "
+                                                                   "DuckDB reads at most 27 by default)")
+    parser.add_argument('--frame-mb', type=float, default=0, help="Start a new zstd frame every this many "
+                                                                  "uncompressed MiB (0: one frame per file)")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    os.makedirs(args.outdir, exist_ok=True)
+    sizes = zipf_sizes(args.comments, args.subs, args.skew, rng)
+    authors = [ '[deleted]' ] * 20 + [ f'user_{b36(rng.randrange(MAX_ID))}' for _ in range(max(args.comments // 20, 10)) ]
+    next_id = 36**5
+    total = 0
+    for i, n_comments in enumerate(sizes):
+        sub = f'sub{i:04d}'
+        # Active authors post much more: sample with Zipf-like weights
+        sub_authors = rng.choices(authors, weights=[ 1/(j+1) for j in range(len(authors)) ], k=200)
+        t0 = 1200000000 + rng.randrange(10**8)
+        n_submissions = max(1, n_comments // 10)
+        links = [ b36(next_id + j) for j in range(n_submissions) ]
+        times = sorted(t0 + rng.randrange(3 * 10**8) for _ in range(n_submissions))
+        objs = (submission(rng, sub, links[j], times[j], sub_authors) for j in range(n_submissions))
+        total += write_file(os.path.join(args.outdir, f'{sub}_submissions.zst'), objs, rng, args)
+        next_id += n_submissions
+        times = sorted(t0 + rng.randrange(3 * 10**8) for _ in range(n_comments))
+        objs = (comment(rng, sub, b36(next_id + j), times[j], sub_authors, links) for j in range(n_comments))
+        total += write_file(os.path.join(args.outdir, f'{sub}_comments.zst'), objs, rng, args)
+        next_id += n_comments
+    print(f"{args.outdir}: {args.subs} subreddits, {total:,} lines")
+
+
+if __name__ == '__main__':
+    main()
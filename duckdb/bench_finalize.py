@@ -0,0 +1,81 @@
+"""Time the sample queries before and after reddit_to_duckdb.py --finalize
+
+Copies DB, times the queries on the copy as it is, finalizes the copy
+(sorted tables, id indexes only), and times them again.  The original
+is not changed.
+
+    python bench_finalize.py reddit.db [--subreddit The_Donald]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import duckdb
+
+from reddit_to_duckdb import finalize
+
+
+# The queries of test_duckdb.py and test_duckdb2.py, and the access
+# patterns of the README: one subreddit, one month of it, one id.
+QUERIES = {
+    'test_duckdb: top authors of a subreddit':
+        "select author, count(*) as cnt from comments where subreddit=$sub group by author order by -cnt limit 10",
+    'test_duckdb2: authors by subreddit':
+        "select subreddit, author, count(*) as count, avg(score) as avgscore from comments "
+        "where typeof(score)=='BIGINT' group by subreddit,author order by subreddit, -avgscore",
+    'one month of a subreddit':
+        "select subreddit, author, created_utc, score, body, id, parent_id, link_id from comments "
+        "where subreddit=$sub and created_utc >= $start and created_utc < $start + 30*86400",
+    'comment by id':
+        "select * from comments where id=$id",
+    }
+
+
+def time_queries(db, params, repeat):
+    """Return {query name: best time in seconds}"""
+    times = { }
+    for name, sql in QUERIES.items():
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.time()
+            db.execute(sql, { k: v for k, v in params.items() if f'${k}' in sql }).fetchall()
+            best = min(best, time.time() - start)
+        times[name] = best
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('db')
+    parser.add_argument('--subreddit', help="default: the one with the most comments")
+    parser.add_argument('--repeat', type=int, default=5, help="Report the best of this many runs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(args.db))) as tmpdir:
+        copy = os.path.join(tmpdir, 'bench.db')
+        shutil.copy(args.db, copy)
+        db = duckdb.connect(copy)
+        sub = args.subreddit or db.execute("select subreddit from comments group by subreddit order by count(*) desc limit 1").fetchone()[0]
+        start, id_ = db.execute("select median(created_utc)::BIGINT, any_value(id) from comments where subreddit=$sub",
+                                { 'sub': sub }).fetchone()
+        params = { 'sub': sub, 'start': start, 'id': id_ }
+        n = db.execute("select count(*) from comments").fetchone()[0]
+        print(f"{n:,} comments, subreddit {sub}")
+
+        before = time_queries(db, params, args.repeat)
+        t = time.time()
+        finalize(db)
+        print(f"finalize: {time.time()-t:.1f} s")
+        after = time_queries(db, params, args.repeat)
+        db.close()
+
+    print(f"{'':40s} {'before':>10s} {'after':>10s}")
+    for name in QUERIES:
+        print(f"{name:40s} {before[name]*1000:8.1f}ms {after[name]*1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,9 @@
 
 import argparse
 import glob
-import itertools
 import os
 from pathlib import Path
+import re
 from resource import getrlimit, setrlimit, RLIMIT_NOFILE
 import sys
 import time
@@ -15,56 +15,10 @@ import duckdb
 BATCHSIZE = 10000
 
 
-def batched(iterable, n, *, strict=False):
-    """like itertools.batched but that is python 3.12+"""
-    # batched('ABCDEFG', 3) → ABC DEF G
-    if n < 1:
-        raise ValueError('n must be at least one')
-    iterator = iter(iterable)
-    while batch := tuple(itertools.islice(iterator, n)):
-        if strict and len(batch) != n:
-            raise ValueError('batched(): incomplete batch')
-        yield batch
-
-def populate_db(db, file_paths):
-    settings = f'compression=zstd, format=newline_delimited, union_by_name=true, ignore_errors=true'
-
-    # Manage alreday-loaded files
-    db.execute('CREATE TABLE IF NOT EXISTS loaded_files (file VARCHAR, time INT)')
-    loaded_files = { x[0] for x in db.execute('SELECT file FROM loaded_files').fetchall() }
-    #print(loaded_files)
-    db.commit()
-
-    # Split files based on whether they are comments or submissions and write paths in the correct format
-
-    comments_paths = []
-    submissions_paths = []
-
-    n_already_loaded = 0
-    for fp in file_paths:
-        if fp in loaded_files:
-            #print(f"File already loaded: {fp}")
-            n_already_loaded += 1
-            continue
-        if fp.endswith('comments.zst'):
-            comments_paths.append(fp)
-        elif fp.endswith('submissions.zst'):
-            submissions_paths.append(fp)
-        else:
-            raise Exception(f'Strange path {fp} encountered!')
-    print(f"Files already loaded: {n_already_loaded}")
-    sys.stdout.flush()
-
-    #comments_paths = ['"{}"'.format(x) for x in comments_paths]
-    #submissions_paths = ['"{}"'.format(x) for x in submissions_paths]
-
-    #comments_paths = ', '.join(comments_paths)
-    #submissions_paths = ', '.join(submissions_paths)
-
+SCHEMAS = {
     # See type names in types API:
     # https://duckdb.org/docs/api/python/types
-
-    submissions_schema = """{
+    'submissions': """{
     subreddit: 'VARCHAR',
     id: 'VARCHAR',
     created_utc: 'BIGINT',
@@ -79,9 +33,8 @@ def populate_db(db, file_paths):
     title: 'VARCHAR',
     url: 'VARCHAR',
     selftext: 'VARCHAR',
-    }"""
-
-    comments_schema = """{
+    }""",
+    'comments': """{
     subreddit: 'VARCHAR',
     author: 'VARCHAR',
     id: 'VARCHAR',
@@ -98,79 +51,145 @@ def populate_db(db, file_paths):
     name: 'VARCHAR',
     body: 'VARCHAR',
     moderator: 'VARCHAR',
-    }"""
-
-    if len(comments_paths) > 0:
-        comments_paths_batched = batched(comments_paths, BATCHSIZE)
-        comments = next(comments_paths_batched)
-        comments = sort_by_size(comments)
-        print(f'{time.ctime()} Ingesting comments (batch 1 of {len(comments_paths)//BATCHSIZE+1}): {comments[0]} > ?')
-        sizes = ' '.join(str(Path(c).stat().st_size) for c in comments)
-        print(f'Sizes: {sizes}')
-        sys.stdout.flush()
-        comments_str = ",".join(f'"{x}"' for x in comments)
-        db.begin()
-        db.execute(
-            f'CREATE TABLE IF NOT EXISTS comments '
-            f'AS (SELECT * FROM '
-            f'read_json_auto([{comments_str}], {settings}, columns={comments_schema}, sample_size=1))'
-            )
-        db.executemany('INSERT INTO loaded_files VALUES (?, ?)', [(c, time.time()) for c in comments])
-        db.commit()
-        for i, comments in enumerate(comments_paths_batched, start=2):
-            comments = sort_by_size(comments)
-            print(f'{time.ctime()} Ingesting comments (batch {i} of {len(comments_paths)//BATCHSIZE+1}): {comments[0]} > ?')
-            sizes = ' '.join(str(Path(c).stat().st_size) for c in comments)
-            print(f'Sizes: {sizes}')
+    }""",
+    }
+
+
+def parse_size(size):
+    """'1234M', '12.5 GiB', '3GB' -> bytes"""
+    m = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)(i?B)?\s*', size, re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Can't parse size: {size!r}")
+    return int(float(m[1]) * 1024**' KMGT'.index(m[2].upper() or ' '))
+
+
+def pack_batches(files, max_bytes, max_files):
+    """Split files into batches of at most max_bytes compressed bytes and max_files files
+
+    First fit decreasing: largest files first, each into the first
+    batch it fits in.  A file bigger than max_bytes gets a batch of its
+    own.  Within a batch, files are largest first.
+    """
+    batches = [ ]   # [bytes, files]
+    for size, file_ in sorted(((Path(f).stat().st_size, f) for f in files), reverse=True):
+        for batch in batches:
+            if batch[0] + size <= max_bytes and len(batch[1]) < max_files:
+                break
+        else:
+            batch = [ 0, [ ] ]
+            batches.append(batch)
+        batch[0] += size
+        batch[1].append(file_)
+    return [ batch[1] for batch in batches ]
+
+
+def populate_db(db, file_paths, batch_bytes, max_files=BATCHSIZE):
+    settings = f'compression=zstd, format=newline_delimited, union_by_name=true, ignore_errors=true'
+
+    # Manage alreday-loaded files
+    db.execute('CREATE TABLE IF NOT EXISTS loaded_files (file VARCHAR, time INT)')
+    loaded_files = { x[0] for x in db.execute('SELECT file FROM loaded_files').fetchall() }
+    #print(loaded_files)
+    db.commit()
+
+    # Split files based on whether they are comments or submissions
+    paths = { 'comments': [ ], 'submissions': [ ] }
+    n_already_loaded = 0
+    for fp in file_paths:
+        if fp in loaded_files:
+            #print(f"File already loaded: {fp}")
+            n_already_loaded += 1
+            continue
+        if fp.endswith('comments.zst'):
+            paths['comments'].append(fp)
+        elif fp.endswith('submissions.zst'):
+            paths['submissions'].append(fp)
+        else:
+            raise Exception(f'Strange path {fp} encountered!')
+    print(f"Files already loaded: {n_already_loaded}")
+    sys.stdout.flush()
+
+    for table, table_paths in paths.items():
+        batches = pack_batches(table_paths, batch_bytes, max_files)
+        for i, batch in enumerate(batches, start=1):
+            sizes = [ Path(f).stat().st_size for f in batch ]
+            print(f'{time.ctime()} Ingesting {table} (batch {i} of {len(batches)}): '
+                  f'{len(batch)} files, {sum(sizes)/2**20:,.0f} MB: {batch[0]} > ?')
+            print(f'Sizes: {" ".join(str(x) for x in sizes)}')
             sys.stdout.flush()
-            comments_str = ",".join(f'"{x}"' for x in comments)
+            files_str = ",".join(f'"{x}"' for x in batch)
+            select = f'SELECT * FROM read_json_auto([{files_str}], {settings}, columns={SCHEMAS[table]}, sample_size=1)'
+            exists = db.execute('SELECT count(*) FROM duckdb_tables() WHERE table_name = ?', (table, )).fetchone()[0]
+            # The data and its loaded_files rows are committed together
             db.begin()
-            db.execute(
-                f'INSERT INTO comments '
-                f'(SELECT * FROM '
-                f'read_json_auto([{comments_str}], {settings}, columns={comments_schema}, sample_size=1))'
-                )
-            db.executemany('INSERT INTO loaded_files VALUES (?, ?)', [(c, time.time()) for c in comments])
+            if exists:
+                db.execute(f'INSERT INTO {table} ({select})')
+            else:
+                db.execute(f'CREATE TABLE {table} AS ({select})')
+            db.executemany('INSERT INTO loaded_files VALUES (?, ?)', [(f, time.time()) for f in batch])
             db.commit()
+    db.close()
 
-    if len(submissions_paths) > 0:
-        submissions_paths_batched = batched(submissions_paths, BATCHSIZE)
-        submissions = next(submissions_paths_batched)
-        submissions = sort_by_size(submissions)
-        print(f'{time.ctime()} Ingesting submissions (batch 1 of {len(submissions_paths)//BATCHSIZE+1}): {submissions[0]} > ?')
-        sizes = ' '.join(str(Path(s).stat().st_size) for s in submissions)
-        print(f'Sizes: {sizes}')
-        sys.stdout.flush()
-        submissions_str = ",".join(f'"{x}"' for x in submissions)
+# Only point lookups need ART indexes.  Scans by subreddit and time use
+# the min/max zone maps of row groups instead, which work well once the
+# tables are sorted by --finalize.
+INDEXES = [
+    ('submissions', 'id'),
+    ('comments', 'id'),
+    ('comments', 'link_id'),
+    ]
+
+
+def tables(db):
+    return { x[0] for x in db.execute('SELECT table_name FROM duckdb_tables()').fetchall() }
+
+
+def make_indexes(db):
+    existing_indexes = { x[0] for x in db.execute('select index_name from duckdb_indexes').fetchall() }
+    print(existing_indexes)
+    existing_tables = tables(db)
+    for table, cols in INDEXES:
+        name = f'idx_{table[:3]}_' + '_'.join(x[:3] for x in cols.split(', '))
+        # IF NOT EXIST isn't implemented
+        print(name)
+        if name in existing_indexes or table not in existing_tables:
+            continue
+        cmd = f"CREATE INDEX {name} ON {table} ({cols})"
+        print(cmd)
         db.begin()
-        db.execute(
-            f'CREATE TABLE IF NOT EXISTS submissions '
-            f'AS (SELECT * FROM '
-            f'read_json_auto([{submissions_str}], {settings}, columns={submissions_schema}, sample_size=1))'
-            )
-        db.executemany('INSERT INTO loaded_files VALUES (?, ?)', [(s, time.time()) for s in submissions])
+        db.execute(cmd)
         db.commit()
-        for i, submissions in enumerate(submissions_paths_batched, start=2):
-            submissions = sort_by_size(submissions)
-            print(f'{time.ctime()} Ingesting submissions (batch {i} of {len(submissions_paths)//BATCHSIZE+1}): {submissions[0]} > ?')
-            sizes = ' '.join(str(Path(s).stat().st_size) for s in submissions)
-            print(f'Sizes: {sizes}')
-            sys.stdout.flush()
-            submissions_str = ",".join(f'"{x}"' for x in submissions)
-            db.begin()
-            db.execute(
-                f'CREATE TABLE IF NOT EXISTS submissions '
-                f'AS (SELECT * FROM '
-                f'read_json_auto([{submissions_str}], {settings}, columns={submissions_schema}, sample_size=1))'
-                )
-            db.executemany('INSERT INTO loaded_files VALUES (?, ?)', [(s, time.time()) for s in submissions])
-            db.commit()
-    db.close()
+    print("ANALYZE;")
+    db.begin()
+    db.execute("ANALYZE;")
+    db.commit()
 
-def sort_by_size(files):
-    sizes_x = [ (Path(x).stat().st_size, x) for x in files ]
-    sizes_x.sort(reverse=True)
-    return [ x[1] for x in sizes_x ]
+
+def finalize(db):
+    """Rewrite the tables ordered by (subreddit, created_utc), then make indexes
+
+    DuckDB stores min/max of every column per row group (zone maps).  In
+    a sorted table, a query for one subreddit, or a time range of it,
+    only reads the few row groups that can match.  Old indexes go with
+    the old tables.
+    """
+    db.execute('SET preserve_insertion_order = true')
+    existing_tables = tables(db)
+    for table in ('submissions', 'comments'):
+        if table not in existing_tables:
+            continue
+        start = time.time()
+        print(f"{time.ctime()} Sorting {table}")
+        sys.stdout.flush()
+        db.begin()
+        db.execute(f'DROP TABLE IF EXISTS {table}_sorted')
+        db.execute(f'CREATE TABLE {table}_sorted AS SELECT * FROM {table} ORDER BY subreddit, created_utc')
+        db.execute(f'DROP TABLE {table}')
+        db.execute(f'ALTER TABLE {table}_sorted RENAME TO {table}')
+        db.commit()
+        print(f"{table}: sorted in {time.time()-start:.1f} s")
+    db.execute('CHECKPOINT')
+    make_indexes(db)
 
 
 if __name__ == "__main__":
@@ -179,9 +198,13 @@ if __name__ == "__main__":
     parser.add_argument('db', type=str, help="DuckDB database file")
     parser.add_argument('files', nargs='+', help="Files to ingest")
     parser.add_argument('-c','--cpus', type=int, default=int(os.getenv("SLURM_CPUS_PER_TASK",1)), help="How many CPUs to use, default %(default)s")
-    parser.add_argument('-b','--batchsize', type=int, default=BATCHSIZE, help="How many files to import at once")
+    parser.add_argument('-b','--batchsize', type=int, default=BATCHSIZE, help="At most this many files to import at once")
+    parser.add_argument('--batch-mem-fraction', type=float, default=0.25,
+                        help="Batches have at most this fraction of the memory limit in compressed bytes, default %(default)s")
     parser.add_argument('--memlimit', help="Set a memory limit")
-    parser.add_argument('--index', action='store_true', help="Don't do anything, just make indexes in the db")
+    parser.add_argument('--index', action='store_true', help="Don't do anything, just make the (id) indexes in the db")
+    parser.add_argument('--finalize', action='store_true', help="Don't do anything, just rewrite the tables sorted by "
+                                                                "(subreddit, created_utc) and make the indexes")
     args = parser.parse_args()
 
     db = duckdb.connect(args.db, read_only=False)
@@ -209,37 +232,12 @@ if __name__ == "__main__":
 
     # --index: don't do anything else, but make indexes
     if args.index:
-        existing_indexes = { x[0] for x in db.execute('select index_name from duckdb_indexes').fetchall() }
-        print(existing_indexes)
-        indexes = [
-            ('submissions', 'subreddit, created_utc'),
-            ('submissions', 'subreddit, author'),
-            ('submissions', 'id'),
-            ('submissions', 'author'),
-            ('comments', 'subreddit, created_utc'),
-            ('comments', 'subreddit, author'),
-            ('comments', 'subreddit, author, score'),
-            ('comments', 'author', 'created_utc'),
-            ('comments', 'id'),
-            ('comments', 'link_id'),
-            ('comments', 'parent_id'),
-            ]
-
-        for i, (table, cols) in enumerate(indexes):
-            name = f'idx_{table[:3]}_' + '_'.join(x[:3] for x in cols.split(', '))
-            # IF NOT EXIST isn't implemented
-            print(name)
-            if name in existing_indexes:
-                continue
-            cmd = f"CREATE INDEX {name} ON {table} ({cols})"
-            print(cmd)
-            db.begin()
-            db.execute(cmd)
-            db.commit()
-        print("ANALYZE;")
-        db.begin()
-        db.execute("ANALYZE;")
-        db.commit()
+        make_indexes(db)
+        exit(0)
+
+    # --finalize: don't do anything else, but sort the tables and make indexes
+    if args.finalize:
+        finalize(db)
         exit(0)
 
 
@@ -247,5 +245,10 @@ if __name__ == "__main__":
     BATCHSIZE = args.batchsize
     setrlimit(RLIMIT_NOFILE, (max(BATCHSIZE+1000, getrlimit(RLIMIT_NOFILE)[0]), getrlimit(RLIMIT_NOFILE)[1]))
 
+    # Batches are packed by compressed size against the memory limit
+    # (DuckDB's default, if none was set).
+    batch_bytes = int(parse_size(db.execute("SELECT current_setting('memory_limit')").fetchone()[0]) * args.batch_mem_fraction)
+    print(f"Batches of at most {batch_bytes/2**20:,.0f} MB compressed")
+
     files = args.files = sum((glob.glob(f) for f in args.files), [])
-    populate_db(db, args.files)
+    populate_db(db, args.files, batch_bytes, BATCHSIZE)
@@ -0,0 +1,88 @@
+"""Turn JSON lines into database rows for a list of COLUMNS
+
+COLUMNS are the (name, type[, function]) tuples of load-queue.py: the
+value of a column is function(obj) if there is a function, else
+obj.get(name).
+"""
+
+import orjson
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+# Exceptions that mean a line can't be made into a row
+BAD_LINE = (KeyError, ValueError, TypeError, AttributeError)
+
+
+def make_row(columns):
+    """Compile a function obj -> row tuple for columns
+
+    Same result as the generator
+    tuple(col[2](obj) if len(col)>2 else obj.get(col[0], None) for col in columns),
+    but as one straight-line function made once per schema.
+    """
+    namespace = { }
+    values = [ ]
+    for i, col in enumerate(columns):
+        if len(col) > 2:
+            namespace[f'f{i}'] = col[2]
+            values.append(f'f{i}(obj)')
+        else:
+            values.append(f'get({col[0]!r})')
+    exec(f"def row(obj):\n"
+         f"    get = obj.get\n"
+         f"    return ({', '.join(values)},)\n",
+         namespace)
+    return namespace['row']
+
+
+def make_decoder(columns, engine='auto'):
+    """Return a function line -> row tuple, raising one of BAD_LINE for bad lines
+
+    engine 'orjson' parses the whole line into a dict.  'simdjson'
+    (pysimdjson) parses it into a lazy document and only the values of
+    the columns are ever made into Python objects, so long unused
+    fields like body, selftext, all_awardings or media cost almost
+    nothing.  Column values that are objects or arrays are made into
+    dicts and lists, as orjson gives them.  'auto' uses simdjson if it
+    is installed.  Make the decoder in the process that uses it.
+    """
+    row = make_row(columns)
+    if engine == 'auto':
+        engine = 'simdjson' if simdjson is not None else 'orjson'
+
+    if engine == 'orjson':
+        loads = orjson.loads
+        def decode(line):
+            return row(loads(line))
+    elif engine == 'simdjson':
+        if simdjson is None:
+            raise ImportError("engine 'simdjson' needs pysimdjson installed")
+        parser = simdjson.Parser()
+        lazy = (simdjson.Object, simdjson.Array)
+        def plain(value):
+            """Lazy values (which can't be pickled) as a dict or list"""
+            if isinstance(value, simdjson.Object):
+                return value.as_dict()
+            if isinstance(value, simdjson.Array):
+                return value.as_list()
+            return value
+        def decode(line):
+            nonlocal parser
+            try:
+                doc = parser.parse(line)
+            except RuntimeError:
+                # Something still references the previous document
+                # (a non-scalar column value): start a new parser.
+                parser = simdjson.Parser()
+                doc = parser.parse(line)
+            values = row(doc)
+            if any(isinstance(value, lazy) for value in values):
+                values = tuple(map(plain, values))
+            return values
+    else:
+        raise ValueError(f"Unknown JSON engine: {engine}")
+    return decode
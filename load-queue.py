@@ -1,9 +1,14 @@
 import argparse
+import bisect
+import collections
+import cProfile
 import ctypes
-from datetime import datetime
+from datetime import datetime, timezone
 import glob
 import itertools
 import logging
+import marshal
+import math
 import multiprocessing
 import os
 import re
@@ -11,8 +16,13 @@ import sqlite3
 import sys
 import time
 
+import numpy as np
 import orjson as json
+import extract
+import shmring
+from socialmediadata import hll
 import zst
+import zstandard
 
 
 # default CPUs
@@ -32,9 +42,70 @@ parser.add_argument('--print-every', type=int, default=1, help="How often to pri
 parser.add_argument('--insert-batch', type=int, default=10, help="Runs inserts every this many chunks")
 parser.add_argument('--comments', action='store_true', help="process comments files")
 parser.add_argument('--index', action='store_true', help="Do nothing but create indexes")
+parser.add_argument('--append', action='store_true', help="Skip rows whose id is already in DB, using a sorted id array "
+                                                           "(DB.TABLE-ids.npy, 8 bytes per row in memory) built once from the table")
+parser.add_argument('--shard', help="K/N: ingest only the K'th of N size-balanced parts of FILES into DB.shardK.  "
+                                    "'slurm' takes K and N from the SLURM array task")
+parser.add_argument('--merge', action='store_true', help="Do nothing but merge the shard databases FILES into DB, then create indexes")
+parser.add_argument('--split-years', action='store_true', help="Do nothing but copy the tables of DB (or, with --merge, of the shard "
+                                                              "databases FILES) into one database per year of created_utc, DB.YYYY, "
+                                                              "with DB.manifest.json for socialmediadata.router, then make their indexes "
+                                                              "(and --cluster, --rollups, --fts)")
+parser.add_argument('--rollups', action='store_true', help="Do nothing but (re)make the tables comments_daily and submissions_daily "
+                                                           "of counts, score sums, first/last times and HyperLogLog author sketches "
+                                                           "per (subreddit, day).  Can be combined with --index and --merge")
+parser.add_argument('--fts', action='store_true', help="Do nothing but make (or continue making) the FTS5 full-text indexes "
+                                                       "comments_fts (body) and submissions_fts (title, selftext).  "
+                                                       "Can be combined with --index and --merge")
+parser.add_argument('--cluster', action='store_true', help="With --index/--merge: first rewrite the tables as WITHOUT ROWID tables "
+                                                           "ordered by (subreddit, created_utc, id), replacing that index")
+parser.add_argument('--normalize', action='store_true', help="Store subreddit and author as integer ids of the subreddits and authors "
+                                                              "tables, in TABLE_data, with a view TABLE of the usual columns.  "
+                                                              "Automatic if DB already has TABLE_data")
+parser.add_argument('--compress-text', action='store_true', help="Store body and selftext as zstd BLOBs, with a dictionary per column trained on "
+                                                                  "the input and kept in the zstd_dicts table.  Read them with zst.register_sqlite(conn)")
+parser.add_argument('--compress-level', type=int, default=3, help="zstd level for --compress-text")
+parser.add_argument('--format', choices=['sqlite', 'parquet', 'duckdb'], default='sqlite',
+                    help="parquet: DB is a directory, decoders write DB/TABLE/subreddit=SUB/year=YEAR/*.parquet "
+                         "(checkpoints and history are in DB/_load-queue.sqlite3).  "
+                         "duckdb: DB is a DuckDB database, decoders make Arrow tables that the inserter appends")
+parser.add_argument('--parquet-rows', type=int, default=250000, help="With --format=parquet: each decoder writes its files "
+                                                                     "after buffering this many rows")
 parser.add_argument('--thin', action='store_true', help="Insert fewer columns")
+parser.add_argument('--json-engine', choices=['auto', 'orjson', 'simdjson'], default='auto',
+                    help="JSON decoder: simdjson (pysimdjson) only materializes the needed columns, auto uses it if installed")
+parser.add_argument('--autoscale', type=float, default=0, help="Every this many seconds, grow or shrink the reader and decoder "
+                                                              "processes (starting from --readers/--decoders) to keep the inserter busy")
+parser.add_argument('--max-procs', type=int, help="With --autoscale: at most this many readers+decoders "
+                                                  "(default: CPUs-1, at least 2 and --readers+--decoders)")
+parser.add_argument('--metrics', help="Append a JSON line of per-stage metrics (latency histograms, lines/s, "
+                                      "utilization, queue depths, bad lines, RSS) to this file every --metrics-every seconds")
+parser.add_argument('--metrics-every', type=float, default=10, help="Seconds between --metrics records")
+parser.add_argument('--profile', help="Run each reader, decoder and inserter process under cProfile, "
+                                      "writing PROFILE/STAGE-PID.prof when it exits (view with python -m pstats)")
+parser.add_argument('--shm-mb', type=int, default=0, help="Pass chunks between processes in shared memory slots of this many MiB "
+                                                         "(0: pickle through the queues).  Needs (readers+decoders+20)*this in /dev/shm")
+parser.add_argument('--rescan-files', action='store_true', help="stat all FILES again instead of using the sizes and mtimes "
+                                                               "cached in DB.files.json for directories that haven't changed")
+parser.add_argument('--split-bytes', type=int, default=0, help="Split files with a sidecar index (python zst.py index/reframe) "
+                                                                "into ranges of this many compressed bytes, read in parallel")
 args = parser.parse_args()
 args.files = sum((glob.glob(f) for f in args.files), [])
+if args.max_procs is None:
+    args.max_procs = max(cpus-1, 2, args.readers + args.decoders)
+# Sizes of FILES, cached for all shards (see file_manifest)
+files_cache = f'{args.db}.files.json'
+# --shard: each part goes into its own database, combined later with --merge
+shard = None
+if args.shard == 'slurm':
+    shard = (int(os.environ['SLURM_ARRAY_TASK_ID']) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0)),
+             int(os.environ['SLURM_ARRAY_TASK_COUNT']))
+elif args.shard:
+    shard = tuple(int(x) for x in args.shard.split('/'))
+if shard is not None:
+    assert 0 <= shard[0] < shard[1], f"Bad shard {shard[0]}/{shard[1]}"
+    args.db = f'{args.db}.shard{shard[0]}'
+    print(f"Shard {shard[0]}/{shard[1]}: {args.db}")
 #print(args.files[:5])
 print(f"Readers: {args.readers}, Decoders: {args.decoders}")
 
@@ -77,7 +148,7 @@ if not args.thin:
     columns_comments.extend([
     ('parent_id', 'TEXT'), # important
     ('controversiality', 'INTEGER'), # important
-    ('distinguished', 'INTEGER'), # important
+    ('distinguished', 'TEXT'), # important
     #('ups', ''),
     #('downs', 'INTEGER'),
     ('gilded', 'INTEGER'), # important
@@ -98,18 +169,48 @@ if args.comments:
     TABLE = 'comments'
     COLUMNS = columns_comments
     TYPE = 'C'
+# --compress-text: these columns are declared ZSTD (the compression is added later)
+TEXT_COLUMNS = ('body', 'selftext')
+if args.compress_text:
+    COLUMNS = [ (col[0], 'ZSTD', *col[2:]) if col[0] in TEXT_COLUMNS else col for col in COLUMNS ]
+
+
+# --normalize: these columns are stored as ids of a lookup table (id, name)
+LOOKUPS = {
+    'subreddit': 'subreddits',
+    'author': 'authors',
+    }
 
 
 # Open and set up database
-conn = sqlite3.connect(args.db)
-conn.execute(f'PRAGMA page_size = 16384;')
-conn.execute(f'PRAGMA mmap_size = {2 * 2**30}')
-conn.execute(f'PRAGMA journal_mode = wal;') # or WAL
-conn.commit()
+if args.format != 'sqlite':
+    import parquetsink
+    assert not (args.index or args.merge or args.split_years or args.rollups or args.fts or args.append or args.normalize or args.compress_text), \
+        f"--format={args.format} doesn't support --index, --merge, --split-years, --rollups, --fts, --append, --normalize or --compress-text"
+if args.format == 'parquet':
+    os.makedirs(args.db, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(args.db, '_load-queue.sqlite3'))
+elif args.format == 'duckdb':
+    import duckdb
+    conn = duckdb.connect(args.db)
+else:
+    conn = sqlite3.connect(args.db)
+if args.format != 'duckdb':
+    conn.execute(f'PRAGMA page_size = 16384;')
+    conn.execute(f'PRAGMA mmap_size = {2 * 2**30}')
+    conn.execute(f'PRAGMA journal_mode = wal;') # or WAL
+    conn.commit()
 
 
-# --index: don't do anything else, but make indexes
-if args.index:
+def ddl(sql):
+    """CREATE TABLE sql for the database in use: DuckDB's INTEGER and REAL are 32 bit"""
+    if args.format == 'duckdb':
+        sql = sql.replace(' INTEGER', ' BIGINT').replace(' REAL', ' DOUBLE')
+    return sql
+
+
+def make_indexes(conn):
+    """Create all indexes (if they don't exist yet) and ANALYZE"""
     indexes = [
         ('submissions', 'subreddit, created_utc'),
         ('submissions', 'subreddit, author'),
@@ -128,10 +229,19 @@ if args.index:
         indexes.extend([
         ('comments', 'parent_id'),
         ])
+    tables = { x[0]: x[1] for x in conn.execute("SELECT name, sql FROM sqlite_master WHERE type='table'") }
 
     #conn.execute('PRAGMA journal_mode = WAL;') # or WAL
     for i, (table, cols) in enumerate(indexes):
         name = '_'.join(x[:3] for x in cols.split(', '))
+        # Normalized tables: the same index, on the id columns
+        if f'{table}_data' in tables:
+            table, cols = f'{table}_data', ', '.join(f'{x}_id' if x in LOOKUPS else x for x in cols.split(', '))
+        if table not in tables:
+            continue
+        # Clustered tables already are this index
+        if cols in ('subreddit, created_utc', 'subreddit_id, created_utc') and 'WITHOUT ROWID' in tables[table]:
+            continue
         cmd = f"CREATE INDEX IF NOT EXISTS idx_{table[:3]}_{name} ON {table} ({cols})"
         print(cmd, flush=True)
         conn.execute(cmd)
@@ -139,39 +249,511 @@ if args.index:
     print("ANALYZE;", flush=True)
     conn.execute("ANALYZE;")
     conn.commit()
+
+
+def cluster_tables(conn):
+    """Rewrite the tables physically ordered by (subreddit, created_utc)
+
+    The new tables are WITHOUT ROWID with PRIMARY KEY (subreddit,
+    created_utc, id), so the table itself is the (subreddit,
+    created_utc) index and a subreddit+time query reads contiguous
+    pages.  This costs one sort of the table, and the old table's pages
+    stay in the file as free pages (reused by the indexes made next).
+    Rows where one of these columns is NULL, or with the same values
+    in them as an earlier row, are dropped, and both are reported.
+    Normalized tables are ordered by subreddit_id instead.
+    """
+    # The full-text indexes refer to rowids, which clustered tables don't have: made again with --fts
+    for table in ('submissions', 'comments'):
+        drop_fts(conn, table)
+    views = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='view'").fetchall()
+    for table, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type='table' "
+                                   "AND name IN ('submissions', 'comments', 'submissions_data', 'comments_data')").fetchall():
+        if 'WITHOUT ROWID' in sql:
+            print(f"{table}: already clustered", flush=True)
+            continue
+        start = time.time()
+        info = conn.execute(f'PRAGMA table_info({table})').fetchall()
+        columns = ", ".join(f"{x[1]} {x[2]}" for x in info)
+        key = 'subreddit_id, created_utc, id' if any(x[1] == 'subreddit_id' for x in info) else 'subreddit, created_utc, id'
+        conn.execute(f'DROP TABLE IF EXISTS {table}_clustered')
+        conn.execute(f'CREATE TABLE {table}_clustered ({columns}, '
+                     f'PRIMARY KEY ({key})) WITHOUT ROWID')
+        cmd = (f'INSERT OR IGNORE INTO {table}_clustered '
+               f'SELECT * FROM {table} ORDER BY {key}')
+        print(cmd, flush=True)
+        conn.execute(cmd)
+        n_old = conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+        n_new = conn.execute(f'SELECT count(*) FROM {table}_clustered').fetchone()[0]
+        n_null = conn.execute(f'SELECT count(*) FROM {table} WHERE '
+                              f'{" OR ".join(f"{col} IS NULL" for col in key.split(", "))}').fetchone()[0]
+        # Views would block the rename: make them again afterwards
+        for view, _ in views:
+            conn.execute(f'DROP VIEW {view}')
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_clustered RENAME TO {table}')
+        for _, view_sql in views:
+            conn.execute(view_sql)
+        conn.commit()
+        print(f"{table}: clustered {n_new:,} rows in {time.time()-start:.1f} s", flush=True)
+        if n_old > n_new:
+            print(f"{table}: WARNING: dropped {n_old-n_new:,} rows: {n_null:,} with a NULL in ({key}), "
+                  f"{n_old-n_new-n_null:,} with the same ({key}) as another row", flush=True)
+            log.warning("cluster: %s: dropped %s rows with a NULL key, %s duplicates", table, n_null, n_old-n_new-n_null)
+
+
+def summarize(keys, times, scores, hashes):
+    """[ (key, n, score_sum, first_utc, last_utc, authors sketch) ] of the runs of equal sorted keys"""
+    if not len(keys):
+        return [ ]
+    starts = np.flatnonzero(np.diff(keys, prepend=keys[0]-1))
+    stops = np.append(starts[1:], len(keys))
+    sketches = hll.group_sketches(np.repeat(np.arange(len(starts)), stops - starts), hashes, len(starts))
+    return list(zip(keys[starts].tolist(), (stops - starts).tolist(), np.add.reduceat(scores, starts).tolist(),
+                    times[starts].tolist(), times[stops-1].tolist(), sketches))
+
+
+def rollup_subreddit(conn, table, sub, batch_size=100000):
+    """Return the rollups of one subreddit: days, months
+
+    Rows come in created_utc order from the (subreddit, created_utc)
+    index.  The days of each batch of rows are done at once, except the
+    last, whose rows are carried over to the next batch.  Months are
+    summed from the parts in each batch.  Months are numbered from 1970.
+    """
+    cursor = conn.execute(f'SELECT created_utc, score, author FROM {table} '
+                          f'WHERE subreddit = ? AND created_utc IS NOT NULL ORDER BY created_utc', (sub, ))
+    memo = { }
+    days, months = [ ], { }
+    carry = [ ]
+    while True:
+        new = cursor.fetchmany(batch_size)
+        rows = carry + new
+        if not rows:
+            break
+        times = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        # The rows of the last day may continue in the next batch
+        n = len(rows)
+        if new:
+            n = int(np.searchsorted(times, times[-1] // 86400 * 86400))
+            carry = rows[n:]
+            rows, times = rows[:n], times[:n]
+        scores = np.fromiter((row[1] if isinstance(row[1], int) else 0 for row in rows), dtype=np.int64, count=n)
+        hashes = hll.hash64([ row[2] for row in rows ], memo)
+        day_keys = times // 86400
+        days.extend(summarize(day_keys, times, scores, hashes))
+        month_keys = day_keys.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        for month, n, score_sum, first, last, sketch in summarize(month_keys, times, scores, hashes):
+            if month not in months:
+                months[month] = [ 0, 0, first, last, hll.HLL() ]
+            m = months[month]
+            m[0] += n
+            m[1] += score_sum
+            m[3] = last
+            m[4].update_bytes(sketch)
+        if not new:
+            break
+        if len(memo) > 10**6:
+            memo.clear()
+    return days, [ (f'{1970 + month // 12}-{month % 12 + 1:02d}', *m[:4], m[4].to_bytes()) for month, m in months.items() ]
+
+
+def make_rollups(conn):
+    """Make TABLE_daily and TABLE_monthly: counts, score sums, first/last times and author sketches
+
+    TABLE_daily is per (subreddit, day), day = created_utc // 86400,
+    and TABLE_monthly per (subreddit, month), month = 'YYYY-MM'.
+    Queries that group by subreddit and time read these instead of the
+    table.  Distinct authors: hll_count(hll_union(authors)) with
+    socialmediadata.hll.register_sqlite(conn), which costs about 10 us
+    per rollup row, so use the months when you can.  Made again from
+    the start each time, one commit per subreddit.
+    """
+    existing = { x[0] for x in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')") }
+    for table in ('submissions', 'comments'):
+        if table not in existing:
+            continue
+        start = time.time()
+        for name, key in ((f'{table}_daily', 'day INTEGER'), (f'{table}_monthly', 'month TEXT')):
+            conn.execute(f'DROP TABLE IF EXISTS {name}')
+            conn.execute(f'CREATE TABLE {name} (subreddit TEXT, {key}, n INTEGER, score_sum INTEGER, first_utc INTEGER, '
+                         f'last_utc INTEGER, authors BLOB, PRIMARY KEY (subreddit, {key.split()[0]})) WITHOUT ROWID')
+        conn.commit()
+        if f'{table}_data' in existing:
+            subs = [ x[0] for x in conn.execute('SELECT name FROM subreddits ORDER BY name') ]
+        else:
+            subs = [ x[0] for x in conn.execute(f'SELECT DISTINCT subreddit FROM {table} ORDER BY subreddit') ]
+        n_rows = 0
+        for i, sub in enumerate(subs):
+            if sub is None:
+                continue
+            days, months = rollup_subreddit(conn, table, sub)
+            conn.executemany(f'INSERT INTO {table}_daily VALUES (?, ?, ?, ?, ?, ?, ?)', [ (sub, *x) for x in days ])
+            conn.executemany(f'INSERT INTO {table}_monthly VALUES (?, ?, ?, ?, ?, ?, ?)', [ (sub, *x) for x in months ])
+            conn.commit()
+            n_rows += sum(x[1] for x in days)
+            if (i+1) % 1000 == 0:
+                print(f"{table} rollups: {i+1:,}/{len(subs):,} subreddits, {n_rows:,} rows, {time.time()-start:.0f} s", flush=True)
+        print(f"{table} rollups: {len(subs):,} subreddits, {n_rows:,} rows in {time.time()-start:.1f} s", flush=True)
+
+
+FTS_COLUMNS = {
+    'submissions': ('title', 'selftext'),
+    'comments': ('body', ),
+    }
+
+
+def drop_fts(conn, table):
+    """Remove the full-text index of table"""
+    conn.execute(f'DROP TABLE IF EXISTS {table}_fts')
+    conn.execute(f'DROP TABLE IF EXISTS {table}_fts_ids')
+    conn.execute(f'DROP VIEW IF EXISTS {table}_fts_content')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'fts_progress'").fetchone():
+        conn.execute('DELETE FROM fts_progress WHERE tbl = ?', (table, ))
+    conn.commit()
+
+
+def make_fts(conn, batch_size=100000):
+    """Make TABLE_fts, FTS5 indexes of the text columns, without another copy of the text
+
+    Rowid tables get an external content index of their rowids (for
+    --compress-text, the content is a view TABLE_fts_content of the
+    decompressed text).  WITHOUT ROWID (--cluster) tables have no rowids
+    to refer to: the index is contentless, and TABLE_fts_ids has the id
+    of each of its rowids.  Rows are added in batches in rowid (or
+    primary key) order, and the last row done is committed with each
+    batch in fts_progress, so this continues where it stopped, and
+    indexes only rows added since the last time.  Search with
+    socialmediadata.search.
+    """
+    zst.register_sqlite(conn)
+    conn.execute('CREATE TABLE IF NOT EXISTS fts_progress (tbl TEXT PRIMARY KEY, last TEXT)')
+    conn.commit()
+    existing = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type IN ('table', 'view')").fetchall())
+    for table, text_cols in FTS_COLUMNS.items():
+        data = f'{table}_data' if f'{table}_data' in existing else table
+        if data not in existing:
+            continue
+        info = conn.execute(f'PRAGMA table_info({data})').fetchall()
+        types = { x[1]: x[2] for x in info }
+        cols = [ col for col in text_cols if col in types ]
+        if not cols:
+            print(f"{table}: no text columns, no full-text index", flush=True)
+            continue
+        fts = f'{table}_fts'
+        texts = ', '.join(f'zstd_decompress({col})' if types[col] == 'ZSTD' else col for col in cols)
+        clustered = 'WITHOUT ROWID' in existing[data]
+        if clustered:
+            # Key order: the primary key columns
+            key = [ x[1] for x in sorted((x for x in info if x[5]), key=lambda x: x[5]) ]
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {fts}_ids (rowid INTEGER PRIMARY KEY, id TEXT)')
+            conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({', '.join(cols)}, content='')")
+        else:
+            key = [ 'rowid' ]
+            content = data
+            if any(types[col] == 'ZSTD' for col in cols):
+                content = f'{fts}_content'
+                conn.execute(f'CREATE VIEW IF NOT EXISTS {content} AS SELECT rowid, '
+                             f'{", ".join(f"zstd_decompress({col}) AS {col}" for col in cols)} FROM {data}')
+            conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({', '.join(cols)}, "
+                         f"content='{content}', content_rowid='rowid')")
+        conn.commit()
+
+        row = conn.execute('SELECT last FROM fts_progress WHERE tbl = ?', (table, )).fetchone()
+        last = json.loads(row[0]) if row else None
+        n_rows = conn.execute(f'SELECT count(*) FROM {data}').fetchone()[0]
+        print(f"{fts}: {n_rows:,} rows, " + (f"continuing after {last}" if last else "starting"), flush=True)
+        key_cols = ', '.join(key)
+        select = f'SELECT {key_cols}, {"id, " if clustered else ""}{texts} FROM {data}'
+        next_rowid = conn.execute(f'SELECT coalesce(max(rowid), 0) + 1 FROM {fts}_ids').fetchone()[0] if clustered else None
+        insert = f'INSERT INTO {fts} (rowid, {", ".join(cols)}) VALUES ({", ".join(["?"] * (len(cols) + 1))})'
+        start = time.time()
+        n_done = 0
+        while True:
+            if last is None:
+                rows = conn.execute(f'{select} ORDER BY {key_cols} LIMIT ?', (batch_size, )).fetchall()
+            else:
+                rows = conn.execute(f'{select} WHERE ({key_cols}) > ({", ".join(["?"] * len(key))}) '
+                                    f'ORDER BY {key_cols} LIMIT ?', (*last, batch_size)).fetchall()
+            if not rows:
+                break
+            if clustered:
+                ids = [ (next_rowid + i, row[len(key)]) for i, row in enumerate(rows) ]
+                conn.executemany(f'INSERT INTO {fts}_ids VALUES (?, ?)', ids)
+                conn.executemany(insert, ((rowid, *row[len(key)+1:]) for (rowid, _), row in zip(ids, rows)))
+                next_rowid += len(rows)
+            else:
+                conn.executemany(insert, rows)
+            last = list(rows[-1][:len(key)])
+            conn.execute('INSERT OR REPLACE INTO fts_progress VALUES (?, ?)', (table, json.dumps(last).decode()))
+            conn.commit()
+            n_done += len(rows)
+            print(f"{fts}: {n_done:,} rows, {n_done/(time.time()-start):,.0f} rows/s", flush=True)
+        if n_done:
+            print(f"{fts}: optimize", flush=True)
+            conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('optimize')")
+            conn.commit()
+        print(f"{fts}: {n_done:,} rows added in {time.time()-start:.1f} s", flush=True)
+
+
+def merge_shards(conn, shards):
+    """Append all tables of the shard databases into conn
+
+    Each table is copied with one INSERT ... SELECT per shard, which
+    SQLite can do without decoding rows when the schemas are the same.
+    Normalized shards have their own lookup ids: new names are added to
+    the lookup tables, and the id columns are translated by name.
+    """
+    # Appending to new pages needs almost no rollback journal, unlike WAL.
+    conn.execute('PRAGMA journal_mode = delete;')
+    lookup_tables = set(LOOKUPS.values())
+    for shard_db in shards:
+        start = time.time()
+        conn.execute('ATTACH DATABASE ? AS shard', (shard_db, ))
+        schema = conn.execute("SELECT name, sql, type FROM shard.sqlite_master "
+                              "WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'").fetchall()
+        # Lookup tables first, views last
+        schema.sort(key=lambda x: (x[0] not in lookup_tables, x[2] == 'view'))
+        for table, sql, type_ in schema:
+            # Rollups of a subreddit could be in many shards, and full-text indexes
+            # have the shard's rowids: made again with --rollups and --fts
+            if table.endswith(('_daily', '_monthly')) or '_fts' in table or table == 'fts_progress':
+                continue
+            if type_ == 'view':
+                conn.execute(sql.replace('CREATE VIEW', 'CREATE VIEW IF NOT EXISTS', 1))
+                continue
+            conn.execute(sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+            if table in lookup_tables:
+                n = conn.execute(f'INSERT OR IGNORE INTO main.{table} (name) SELECT name FROM shard.{table}').rowcount
+            elif table.endswith('_data'):
+                select, joins = [ ], [ ]
+                for col in (x[1] for x in conn.execute(f'PRAGMA shard.table_info({table})')):
+                    lookup = LOOKUPS.get(col[:-3]) if col.endswith('_id') else None
+                    if lookup is None:
+                        select.append(f'd.{col}')
+                        continue
+                    select.append(f'm_{lookup}.id')
+                    joins.append(f'LEFT JOIN shard.{lookup} s_{lookup} ON s_{lookup}.id = d.{col} '
+                                 f'LEFT JOIN main.{lookup} m_{lookup} ON m_{lookup}.name = s_{lookup}.name')
+                n = conn.execute(f'INSERT INTO main.{table} SELECT {", ".join(select)} '
+                                 f'FROM shard.{table} d {" ".join(joins)}').rowcount
+            elif table == 'zstd_dicts':
+                # By name: shards from before tbl and col have fewer columns
+                zst.create_dict_table(conn)
+                columns = ", ".join(x[1] for x in conn.execute(f'PRAGMA shard.table_info({table})'))
+                n = conn.execute(f'INSERT OR IGNORE INTO main.{table} ({columns}) SELECT {columns} FROM shard.{table}').rowcount
+            else:
+                n = conn.execute(f'INSERT INTO main.{table} SELECT * FROM shard.{table}').rowcount
+            print(f"{shard_db}: {table}: {n:,} rows", flush=True)
+        conn.commit()
+        conn.execute('DETACH DATABASE shard')
+        print(f"{shard_db}: merged in {time.time()-start:.1f} s", flush=True)
+
+
+def year_start(year):
+    return int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+def split_years(sources, base, batch_size=100000):
+    """Copy the tables of the sources into the databases BASE.YYYY, one per year of created_utc
+
+    Each source is read once, and its rows are sent to the database of
+    their year (BASE.none for rows without a time), which then get the
+    same post-processing as --merge.  Normalized sources are copied
+    through their views, as plain tables.  BASE.manifest.json, written
+    last, lists the databases with their time ranges and row counts.
+    """
+    manifest_path = f'{base}.manifest.json'
+    existing = glob.glob(f'{glob.escape(base)}.[0-9][0-9][0-9][0-9]') + glob.glob(f'{glob.escape(base)}.none')
+    assert not existing and not os.path.exists(manifest_path), \
+        f"--split-years: remove the outputs of an earlier split first: {sorted(existing) + [manifest_path]}"
+    outputs = { }    # year: connection
+    def output(year):
+        if year not in outputs:
+            out = outputs[year] = sqlite3.connect(f'{base}.{"none" if year is None else year}')
+            out.execute('PRAGMA page_size = 16384;')
+            out.execute('PRAGMA journal_mode = delete;')
+        return outputs[year]
+
+    for source in sources:
+        start = time.time()
+        src = sqlite3.connect(f'file:{source}?mode=ro', uri=True)
+        names = { x[0] for x in src.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')") }
+        for table in ('submissions', 'comments'):
+            if table not in names:
+                continue
+            info = src.execute(f'PRAGMA table_info({table})').fetchall()
+            # Normalized: the declared types are those of the data table
+            types = dict(src.execute(f"SELECT name, type FROM pragma_table_info('{table}_data')"))
+            columns = [ (x[1], types.get(x[1]) or x[2] or 'TEXT') for x in info ]
+            create = f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(" ".join(x) for x in columns)})'
+            insert = f'INSERT INTO {table} ({", ".join(x[0] for x in columns)}) VALUES ({", ".join("?"*len(columns))})'
+            i_time = [ x[0] for x in columns ].index('created_utc')
+            # Year of each time: bisect in the start times of the years (gmtime outside of them)
+            years = range(2005, datetime.now(timezone.utc).year + 2)
+            starts = [ year_start(year) for year in years ]
+            def year_of(t):
+                i = bisect.bisect_right(starts, t)
+                return years[i-1] if 0 < i < len(starts) else time.gmtime(t).tm_year
+            cursor = src.execute(f'SELECT {", ".join(x[0] for x in columns)} FROM {table}')
+            n = 0
+            while rows := cursor.fetchmany(batch_size):
+                by_year = collections.defaultdict(list)
+                for row in rows:
+                    t = row[i_time]
+                    by_year[None if t is None else year_of(t)].append(row)
+                for year, year_rows in by_year.items():
+                    out = output(year)
+                    out.execute(create)
+                    out.executemany(insert, year_rows)
+                for out in outputs.values():
+                    out.commit()
+                n += len(rows)
+            print(f"{source}: {table}: {n:,} rows", flush=True)
+        if 'zstd_dicts' in names:
+            dicts = src.execute('SELECT * FROM zstd_dicts').fetchall()
+            sql = src.execute("SELECT sql FROM sqlite_master WHERE name='zstd_dicts'").fetchone()[0]
+            for out in outputs.values():
+                out.execute(sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+                out.executemany(f'INSERT OR IGNORE INTO zstd_dicts VALUES ({", ".join("?"*len(dicts[0]))})', dicts)
+                out.commit()
+        src.close()
+        print(f"{source}: split in {time.time()-start:.1f} s", flush=True)
+
+    manifest = { 'source': [ os.path.abspath(x) for x in sources ], 'time': time.time(), 'shards': [ ] }
+    for year, out in sorted(outputs.items(), key=lambda x: (x[0] is None, x[0] or 0)):
+        print(f"{base}.{year or 'none'}:", flush=True)
+        if args.cluster:
+            cluster_tables(out)
+        make_indexes(out)
+        if args.rollups:
+            make_rollups(out)
+        if args.fts:
+            make_fts(out)
+        tables = { }
+        for (table, ) in out.execute("SELECT name FROM sqlite_master WHERE name IN ('submissions', 'comments')").fetchall():
+            n, first, last = out.execute(f'SELECT count(*), min(created_utc), max(created_utc) FROM {table}').fetchone()
+            tables[table] = { 'rows': n, 'first_utc': first, 'last_utc': last }
+        out.close()
+        manifest['shards'].append({
+            # Relative to the manifest, so that the files can be moved together
+            'path': os.path.basename(f'{base}.{"none" if year is None else year}'),
+            'year': year,
+            'start': None if year is None else year_start(year),
+            'end': None if year is None else year_start(year + 1),
+            'tables': tables,
+            })
+    with open(f'{manifest_path}.tmp', 'wb') as f:
+        f.write(json.dumps(manifest, option=json.OPT_INDENT_2))
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+    print(f"{manifest_path}: {len(manifest['shards'])} databases", flush=True)
+
+
+# --split-years: don't do anything else, but split DB (or the shards) by year
+if args.split_years:
+    split_years(args.files if args.merge else [ args.db ], args.db)
+    # Split from shards, DB is only the base of the names: don't leave it empty
+    if args.merge and not conn.execute("SELECT count(*) FROM sqlite_master").fetchone()[0]:
+        conn.close()
+        for name in (args.db, f'{args.db}-wal', f'{args.db}-shm'):
+            if os.path.exists(name):
+                os.unlink(name)
+    exit(0)
+
+# --index: don't do anything else, but make indexes
+if args.index or ((args.rollups or args.fts) and not args.merge):
+    if args.cluster:
+        cluster_tables(conn)
+    if args.index:
+        make_indexes(conn)
+    if args.rollups:
+        make_rollups(conn)
+    if args.fts:
+        make_fts(conn)
+    exit(0)
+
+# --merge: don't do anything else, but merge shards and make indexes
+if args.merge:
+    merge_shards(conn, args.files)
+    if args.cluster:
+        cluster_tables(conn)
+    make_indexes(conn)
+    if args.rollups:
+        make_rollups(conn)
+    if args.fts:
+        make_fts(conn)
     exit(0)
 
 
 
 # Make columns, etc.
 #conn.execute('CREATE TABLE IF NOT EXISTS submissions (sub TEXT, time INTEGER, author TEXT, body BLOB)')
-conn.execute(f'CREATE TABLE IF NOT EXISTS {TABLE} ('
-             f'{", ".join(" ".join(x[:2]) for x in COLUMNS)}'
-             f')')
+existing = dict(conn.execute("SELECT name, type FROM sqlite_master WHERE name IN (?, ?)", (TABLE, f'{TABLE}_data')).fetchall())
+if f'{TABLE}_data' in existing:
+    args.normalize = True
+assert not (args.normalize and existing.get(TABLE) == 'table'), f"--normalize, but {args.db} has a plain {TABLE} table"
+DATA_TABLE = TABLE
+if args.format == 'parquet':
+    # Rows go to files, the database only has the checkpoints
+    pass
+elif args.normalize:
+    # TABLE_data has ids instead of names, the view TABLE looks like the plain table
+    DATA_TABLE = f'{TABLE}_data'
+    view_cols, joins = [ ], [ ]
+    for col in COLUMNS:
+        if col[0] in LOOKUPS:
+            lookup = LOOKUPS[col[0]]
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {lookup} (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+            view_cols.append(f'{lookup}.name AS {col[0]}')
+            joins.append(f'LEFT JOIN {lookup} ON {lookup}.id = d.{col[0]}_id')
+        else:
+            view_cols.append(f'd.{col[0]}')
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {DATA_TABLE} ('
+                 f'{", ".join(f"{x[0]}_id INTEGER" if x[0] in LOOKUPS else " ".join(x[:2]) for x in COLUMNS)}'
+                 f')')
+    conn.execute(f'CREATE VIEW IF NOT EXISTS {TABLE} AS SELECT {", ".join(view_cols)} '
+                 f'FROM {DATA_TABLE} d {" ".join(joins)}')
+else:
+    conn.execute(ddl(f'CREATE TABLE IF NOT EXISTS {TABLE} ('
+                     f'{", ".join(" ".join(x[:2]) for x in COLUMNS)}'
+                     f')'))
 conn.commit()
+# --cluster: the table is WITHOUT ROWID, and its key columns can't be
+# NULL or the same as those of another row (see cluster_tables)
+CLUSTERED = args.format == 'sqlite' and 'WITHOUT ROWID' in \
+    (conn.execute("SELECT sql FROM sqlite_master WHERE name = ?", (DATA_TABLE, )).fetchone() or [ '' ])[0]
 
 # Store the history of this table
 conn.execute(f'CREATE TABLE IF NOT EXISTS history ('
              f'time TIMESTAMP DEFAULT CURRENT_TIMESTAMP, command TEXT'
              f')')
 conn.commit()
-conn.execute("INSERT INTO history (command) VALUES (?)", (json.dumps(sys.argv), ))
+conn.execute("INSERT INTO history (command) VALUES (?)", (json.dumps(sys.argv).decode(), ))
+conn.commit()
+
+# Checkpoints: files completely loaded, and committed line ranges of others
+conn.execute(ddl('CREATE TABLE IF NOT EXISTS loaded_files (file TEXT, lines INTEGER, time REAL)'))
+conn.execute(ddl('CREATE TABLE IF NOT EXISTS loaded_chunks (file TEXT, start INTEGER, stop INTEGER)'))
+if args.format == 'parquet':
+    # Part files whose line ranges are committed, until they are renamed to their final names
+    conn.execute('CREATE TABLE IF NOT EXISTS parquet_pending (path TEXT)')
 conn.commit()
 
 
 class Averager:
     def __init__(self, alpha=.01):
         self.alpha = alpha
-        self.n = multiprocessing.Value(ctypes.c_long, 0)
-        self.a = multiprocessing.Value(ctypes.c_double, float('nan'))
+        # One lock for both values
+        self.lock = multiprocessing.Lock()
+        self.n = multiprocessing.RawValue(ctypes.c_long, 0)
+        self.a = multiprocessing.RawValue(ctypes.c_double, float('nan'))
     def add(self, x):
-        with self.n.get_lock():
+        with self.lock:
             self.n.value += 1
-            with self.a.get_lock():
-                if self.n.value == 1:
-                    self.a.value = x
-                else:
-                    self.a.value = x*self.alpha + self.a.value*(1-self.alpha)
+            if self.n.value == 1:
+                self.a.value = x
+            else:
+                self.a.value = x*self.alpha + self.a.value*(1-self.alpha)
     @property
     def avg(self):
         return self.a.value
@@ -192,6 +774,22 @@ class RateAvg:
 rate_read = RateAvg()
 rate_decode = RateAvg()
 rate_insert = RateAvg()
+class Histogram:
+    """Counts of chunk times in power of two buckets, shared between processes"""
+    bounds = [ 2.**k for k in range(-10, 7) ]   # ~1 ms ... 64 s, then larger
+    def __init__(self):
+        self.lock = multiprocessing.Lock()
+        self.counts = multiprocessing.RawArray(ctypes.c_long, len(self.bounds) + 1)
+        self.total = multiprocessing.RawValue(ctypes.c_double, 0)
+    def add(self, x):
+        i = bisect.bisect_left(self.bounds, x)
+        with self.lock:
+            self.counts[i] += 1
+            self.total.value += x
+    def buckets(self):
+        """{upper bound: count}, like the le labels of a Prometheus histogram (not cumulative)"""
+        return dict(zip([ f'{b:g}' for b in self.bounds ] + ['+Inf'], self.counts))
+latency = { stage: Histogram() for stage in ('read', 'decode', 'insert') }
 
 
 
@@ -202,45 +800,120 @@ def print_status(extra=''):
                   )
 
 
-def read(file_):
+def read(task):
     """Read and decompress lines from file, put in queue
+
+    Lines stay as bytes and are sent in chunks of (file, first line
+    number, lines), so no per-line tuples need to be pickled.  A task is
+    (file, start_frame, stop_frame, done): a range of frames of one
+    file, or the whole file if stop_frame is None, skipping the sorted
+    (start, stop) line ranges in done, which are already in the
+    database.  After the last line of the file, (file, number of lines,
+    None) is sent.
     """
     os.nice(5)
     queue = queue1
-    file_size = os.stat(file_).st_size
+    file_, start_frame, stop_frame, done = task
     sub = os.path.basename(file_).rsplit('_', 1)[0]
-    lines_file = 0
-    accumulated = [ ]
-    start = time.time()
+    if stop_frame is None:
+        index = None
+        file_size = manifest[file_][0]
+        lines_file = 0
+        to_end = True
+    else:
+        index = zst.load_index(file_)
+        frames = index['frames']
+        end = frames[stop_frame][0] if stop_frame < len(frames) else index['file_size']
+        file_size = end - frames[start_frame][0]
+        lines_file = frames[start_frame][3]
+        to_end = stop_frame >= len(frames)
+        sub = f'{sub}[{start_frame}:{stop_frame}]'
+    lines_seen = lines_file
+    range_ = dict(start_frame=start_frame, stop_frame=stop_frame, index=index)
+    done_stops = [ stop for _, stop in done ]
+
+    def todo(lo, hi):
+        """Yield the parts of the line range [lo, hi) not in done"""
+        for a, b in done[bisect.bisect_right(done_stops, lo):]:
+            if a >= hi:
+                break
+            if a > lo:
+                yield lo, a
+            lo = b
+        if lo < hi:
+            yield lo, hi
+
+    def chunks():
+        """Yield (payload, first_lineno, n_lines, file_bytes_processed) to put into the queue"""
+        nonlocal lines_seen
+        if ring1 is not None and not done:
+            # Whole blocks of lines go into shared memory, unsplit.
+            for parts, n_lines, file_bytes_processed in zst.read_blocks_zst(file_, block_bytes=ring1.slot_bytes, **range_):
+                payload = ring1.put(parts)
+                if payload is None:
+                    # A single line bigger than a slot: send it directly
+                    payload = b''.join(parts)
+                yield payload, lines_seen, n_lines, file_bytes_processed
+                lines_seen += n_lines
+            return
+        accumulated = [ ]
+        first = lines_seen
+        file_bytes_processed = 0
+        for lines, file_bytes_processed in zst.read_line_batches_zst(file_, **range_):
+            for a, b in todo(lines_seen, lines_seen + len(lines)):
+                # Chunks are contiguous line ranges
+                if accumulated and a != first + len(accumulated):
+                    yield accumulated, first, len(accumulated), file_bytes_processed
+                    accumulated = [ ]
+                if not accumulated:
+                    first = a
+                pos, end = a - lines_seen, b - lines_seen
+                while pos < end:
+                    n = min(args.chunk_lines - len(accumulated), end - pos)
+                    accumulated.extend(lines[pos:pos+n])
+                    pos += n
+                    if len(accumulated) == args.chunk_lines:
+                        yield accumulated, first, len(accumulated), file_bytes_processed
+                        accumulated = [ ]
+                        first = lines_seen + pos
+            lines_seen += len(lines)
+        # Put all the last stuff into queue
+        yield accumulated, first, len(accumulated), file_bytes_processed
 
     #print(f"read: starting {file_}")
-    for i, (line, file_bytes_processed) in enumerate(zst.read_lines_zst(file_)):
-        lines_file += 1
-        accumulated.append((i, line))
-        # Every 100000 lines, print status and push into queue.
-        if lines_file % (args.chunk_lines*args.print_every) == 0:
+    lines_read = 0
+    file_bytes_processed = bytes_chunk = 0
+    start = time.time()
+    for n_chunks, (payload, first_lineno, n_lines, file_bytes_processed) in enumerate(chunks(), start=1):
+        # Every chunk, push into queue and maybe print status.
+        if n_chunks % args.print_every == 0:
             #created = datetime.utcfromtimestamp(int(obj['created_utc']))
             print_status(f"{sub:20s} "
                   #f"{created.strftime('%Y-%m-%d %H:%M:%S')} : "
                   f"Tot%: {((file_bytes_processed + bytes_processed.value) / bytes_total) * 100:5.1f}% "
                   f"(bad: {lines_bad.value:,}) "
                   f"File%: {(file_bytes_processed / file_size) * 100:3.0f}% "
-                  f"Line {lines_file:,} ({lines_total.value:,}) "
+                  f"Line {first_lineno+n_lines:,} ({lines_total.value:,}) "
                   )
             sys.stdout.flush()
-            time_read.add(time.time() - start)
-            rate_read.mark()
-            start = time.time()
-            queue.put((file_, accumulated))
-            accumulated = [ ]
-    # Put all the last stuff into queue
-    time_read.add(time.time() - start)
-    rate_read.mark()
-    queue.put((file_, accumulated))
+        time_read.add(time.time() - start)
+        latency['read'].add(time.time() - start)
+        rate_read.mark()
+        queue.put((file_, first_lineno, payload))
+        # Waiting for a full queue isn't reading
+        start = time.time()
+        lines_read += n_lines
+        with stage_lines['read'].get_lock():
+            stage_lines['read'].value += n_lines
+        with bytes_read.get_lock():
+            bytes_read.value += file_bytes_processed - bytes_chunk
+        bytes_chunk = file_bytes_processed
+    if to_end:
+        queue.put((file_, lines_seen, None))
     with bytes_processed.get_lock():
         bytes_processed.value += file_bytes_processed
     with lines_total.get_lock():
-        lines_total.value += lines_file
+        lines_total.value += lines_read
     sys.stdout.flush()
     print_status(f"{sub:20s} "
           #f"{created.strftime('%Y-%m-%d %H:%M:%S')} : "
@@ -251,10 +924,76 @@ def read(file_):
     #queue.close()
 
 
+def id_int(id_):
+    """'t1_abc' -> int('abc', 36), or -1 if it isn't a base 36 id"""
+    try:
+        return int(id_[3:], 36)
+    except (TypeError, ValueError):
+        return -1
+
+
+def existing_ids(conn):
+    """Return the sorted integer ids already in TABLE
+
+    Cached in DB.TABLE-ids.npy and memory mapped; it is rebuilt if the
+    number of rows in the table has changed since.
+    """
+    cache = f'{args.db}.{TABLE}-ids.npy'
+    n_rows = conn.execute(f'SELECT count(*) FROM {DATA_TABLE}').fetchone()[0]
+    if os.path.exists(cache):
+        ids = np.load(cache, mmap_mode='r')
+        if len(ids) == n_rows:
+            print(f"Existing ids: {n_rows:,} from {cache}")
+            return ids
+    start = time.time()
+    ids = np.fromiter((id_int(x[0]) for x in conn.execute(f'SELECT id FROM {DATA_TABLE}')), dtype=np.int64, count=n_rows)
+    ids.sort()
+    np.save(cache, ids)
+    print(f"Existing ids: {n_rows:,} written to {cache} in {time.time()-start:.1f} s")
+    return np.load(cache, mmap_mode='r')
+
+
+def drop_null_keys(rows, file_):
+    """Return the rows without NULL key columns (of a --cluster table), counting the others as bad"""
+    good = [ row for row in rows if all(row[i] is not None for i in KEY_COLS) ]
+    if len(good) < len(rows):
+        with lines_bad.get_lock():
+            lines_bad.value += len(rows) - len(good)
+        log.warning("bad lines: %s: %s with NULL subreddit, created_utc or id", file_, len(rows) - len(good))
+    return good
+
+
+def drop_known(rows):
+    """Return the rows whose id is not in known_ids, counting the others"""
+    if not rows or not len(known_ids):
+        return rows
+    ids = np.fromiter((id_int(row[ID_COL]) for row in rows), dtype=np.int64, count=len(rows))
+    pos = np.minimum(np.searchsorted(known_ids, ids), len(known_ids)-1)
+    known = known_ids[pos] == ids
+    n_known = int(known.sum())
+    if n_known == 0:
+        return rows
+    with lines_dup.get_lock():
+        lines_dup.value += n_known
+    return [ row for row, k in zip(rows, known) if not k ]
+
+
 def decode(queue_in, queue_out):
     """Read from queue, decode JSON and make fields, add to next queue"""
     os.nice(5)
+    decode_line = extract.make_decoder(COLUMNS, args.json_engine)
     accumulated = [ ]
+    # --format=parquet: rows go into files here.  The inserter gets their
+    # line ranges and (still temporary) files in one message, and
+    # publishes the files when it has committed the ranges.
+    sink = None
+    if args.format == 'parquet':
+        sink = parquetsink.PartitionedWriter(os.path.join(args.db, TABLE), COLUMNS, max_rows=args.parquet_rows)
+    sink_ranges = [ ]
+    def flush():
+        paths = [ os.path.relpath(path, args.db) for path in sink.flush() ]
+        queue_out.put((None, 0, 0, (list(sink_ranges), paths)))
+        sink_ranges.clear()
     # While there is stuff in the queue...
     for i in itertools.count():
         x = queue_in.get()
@@ -263,36 +1002,62 @@ def decode(queue_in, queue_out):
         # should raise ValueError once closed, but I haven't gotten
         # that to work.  Maybe it needs to be closed in every process.
         if x == 'DONE':
+            if sink is not None:
+                flush()
             print(' '*7, 'decode: done')
             break
 
         # For each line, load JSON and accumulate whatever our final
         # values will be.
-        file_, lines = x
+        file_, first_lineno, lines = x
+        if lines is None:
+            # End of file marker, for checkpoints
+            queue_out.put((file_, first_lineno, 0, None))
+            continue
+        if not isinstance(lines, list):
+            # Shared memory block (or one oversized line) of whole lines
+            data = ring1.get(lines) if isinstance(lines, tuple) else lines
+            lines = data.split(b'\n')
+            lines.pop()
         #if i % args.print_every == 0:
         #    print_status(f'decode: {len(lines)}')
         #    sys.stdout.flush()
-        for lineno, line in lines:
+        for lineno, line in enumerate(lines, start=first_lineno):
             try:
-                obj = json.loads(line)
-            except (KeyError, json.JSONDecodeError) as err:
+                accumulated.append(decode_line(line))
+            except extract.BAD_LINE as err:
                 with lines_bad.get_lock():
                     lines_bad.value += 1
                 log.warning("bad line: %s: %s", file_, lineno)
 
-            db_row = tuple(col[2](obj)  if  len(col)>2   else   obj.get(col[0], None)
-                           for col in COLUMNS)
-            accumulated.append(db_row)
+        if CLUSTERED:
+            accumulated = drop_null_keys(accumulated, file_)
+        if known_ids is not None:
+            accumulated = drop_known(accumulated)
+        if sink is not None:
+            sink.add(accumulated)
+            sink_ranges.append((file_, first_lineno, len(lines)))
+            if sink.full():
+                flush()
 
         with n_decode.get_lock():
             n_decode.value += 1
+        with stage_lines['decode'].get_lock():
+            stage_lines['decode'].value += len(lines)
         time_decode.add(time.time() - start)
+        latency['decode'].add(time.time() - start)
         rate_decode.mark()
+        if sink is not None:
+            accumulated = [ ]
+            continue
 
-        queue_out.put(accumulated)
+        if args.format == 'duckdb':
+            accumulated = parquetsink.arrow_table(accumulated, COLUMNS)
+        elif ring2 is not None:
+            data = marshal.dumps(accumulated)
+            accumulated = ring2.put([data], len(data)) or data
+        queue_out.put((file_, first_lineno, len(lines), accumulated))
         accumulated = [ ]
-    # Don't forget to push the final stuff through.
-    queue_out.put(accumulated)
 
 
 
@@ -307,9 +1072,82 @@ def batched(iterable, n, *, strict=False):
         yield batch
 
 
-INSERT = f'INSERT INTO {TABLE} VALUES({",".join(["?"]*len(COLUMNS))})'
+# Clustered: a row with the key of another is skipped (and counted) instead of stopping the inserter
+INSERT = f'INSERT {"OR IGNORE " if CLUSTERED else ""}INTO {DATA_TABLE} VALUES({",".join(["?"]*len(COLUMNS))})'
+class Lookup:
+    """The name -> id mapping of a --normalize lookup table, owned by the inserter
+
+    New names get the next ids and are inserted into the table in the
+    same transaction as the rows that use them.
+    """
+    def __init__(self, conn, table):
+        self.table = table
+        self.ids = dict(conn.execute(f'SELECT name, id FROM {table}'))
+        self.next_id = max(self.ids.values(), default=0) + 1
+        self.new = [ ]
+    def get(self, name):
+        id_ = self.ids.get(name)
+        if id_ is None and name is not None:
+            id_ = self.ids[name] = self.next_id
+            self.next_id += 1
+            self.new.append((id_, name))
+        return id_
+    def flush(self, conn):
+        conn.executemany(f'INSERT INTO {self.table} VALUES (?, ?)', self.new)
+        self.new.clear()
+
+
 def insert(queue):
-    """Read from queue and insert into the database"""
+    """Read from queue and insert into the database
+
+    Every commit also records the line ranges (chunks) it contains in
+    loaded_chunks, and files whose lines are all committed in
+    loaded_files, so an interrupted run can be resumed.
+    """
+    global conn
+    pending = [ ]    # (file, start, stop) inserted since the last commit
+    pending_parts = [ ]    # --format=parquet: files of the pending ranges
+    finished = { }   # file: number of lines, once its end has been read
+    if args.format == 'duckdb':
+        # Only this process has the database open, in one transaction
+        # per commit() (DuckDB commits each statement otherwise)
+        conn = duckdb.connect(args.db)
+        conn.begin()
+    # --normalize: (column number, Lookup)
+    lookups = [ (i, Lookup(conn, LOOKUPS[col[0]])) for i, col in enumerate(COLUMNS) if args.normalize and col[0] in LOOKUPS ]
+    def normalize(rows):
+        """Replace names by ids in the lookup columns of rows"""
+        rows = [ list(row) for row in rows ]
+        for i, lookup in lookups:
+            get = lookup.get
+            for row in rows:
+                row[i] = get(row[i])
+            lookup.flush(conn)
+        return rows
+    def commit():
+        if pending:
+            conn.executemany('INSERT INTO loaded_chunks VALUES (?, ?, ?)', pending)
+        if pending_parts:
+            conn.executemany('INSERT INTO parquet_pending VALUES (?)', [ (path, ) for path in pending_parts ])
+        for file_, start, stop in pending:
+            lines_done[file_] += stop - start
+        pending.clear()
+        for file_, n_lines in list(finished.items()):
+            if lines_done[file_] == n_lines:
+                conn.execute('DELETE FROM loaded_chunks WHERE file = ?', (file_, ))
+                conn.execute('INSERT INTO loaded_files VALUES (?, ?, ?)', (file_, n_lines, time.time()))
+                del finished[file_]
+        conn.commit()
+        if pending_parts:
+            # Committed: now their rows may be seen (or published at the next start)
+            parquetsink.publish([ os.path.join(args.db, path) for path in pending_parts ])
+            conn.execute('DELETE FROM parquet_pending')
+            conn.commit()
+            pending_parts.clear()
+        if args.format == 'duckdb':
+            conn.begin()
+        else:
+            conn.execute('PRAGMA shrink_memory;')
     def get():
         """Generator to indefinitely return stuff to insert into the database"""
         for i in itertools.count():
@@ -323,6 +1161,26 @@ def insert(queue):
             #    sys.stdout.flush()
             with n_insert.get_lock():
                 n_insert.value += 1
+            file_, first_lineno, n_lines, x = x
+            if x is None:
+                finished[file_] = first_lineno
+                continue
+            if file_ is None:
+                # --format=parquet: line ranges and the files that have their rows
+                ranges, paths = x
+                pending.extend((f, a, a + n) for f, a, n in ranges)
+                pending_parts.extend(paths)
+                n_lines = sum(n for _, _, n in ranges)
+                x = None
+            elif args.format == 'duckdb':
+                # Arrow table: DuckDB scans it without copying
+                conn.register('batch', x)
+                conn.execute(f'INSERT INTO {TABLE} SELECT * FROM batch')
+                conn.unregister('batch')
+                x = [ ]
+            elif not isinstance(x, list):
+                # Marshalled rows, via shared memory if they fit
+                x = marshal.loads(ring2.get(x) if isinstance(x, tuple) else x)
             # Doing it here:
             #yield from x
             # insert here:
@@ -333,18 +1191,30 @@ def insert(queue):
             #sys.stdout.flush()
             #
             # Direct inserts here:
-            conn.executemany(INSERT, x)
+            if lookups:
+                x = normalize(x)
+            if x:
+                changes = conn.total_changes
+                conn.executemany(INSERT, x)
+                if CLUSTERED and conn.total_changes - changes < len(x):
+                    with lines_dup.get_lock():
+                        lines_dup.value += len(x) - (conn.total_changes - changes)
+            if file_ is not None:
+                pending.append((file_, first_lineno, first_lineno + n_lines))
             if (i+1) % args.insert_batch == 0:
-                conn.commit()
-                conn.execute('PRAGMA shrink_memory;')
+                commit()
                 print(f"Committed batch {i}")
             #
+            with stage_lines['insert'].get_lock():
+                stage_lines['insert'].value += n_lines
             time_insert.add(time.time() - start)
+            latency['insert'].add(time.time() - start)
             rate_insert.mark()
-        conn.commit()
-        conn.execute('PRAGMA shrink_memory;')
+        commit()
         print(f"Committed batch FINAL")
     get()
+    if args.format == 'duckdb':
+        conn.close()
     #for i_batch, batch in enumerate(batched(get(), args.insert_batch)):
     #    conn.executemany(INSERT, get())
     #    conn.commit()
@@ -380,48 +1250,401 @@ else:
         assert all(x.endswith('_comments.zst') for x in args.files), "--comments but not all files end in _comments.zst"
     else:
         assert all(x.endswith('_submissions.zst') for x in args.files), "not all files end in _submissions.zst"
-for file_ in args.files:
-    assert os.path.exists(file_)
 if start is not None or stop is not None or interval is not None:
     args.files = args.files[start:stop:interval]
+args.files = [ os.path.abspath(file_) for file_ in args.files ]
+
+
+def file_manifest(files, cache_file, known_lines={ }, rescan=False):
+    """Return {file: [size, mtime_ns, lines]} of files, stat'ing only files of changed directories
+
+    Stat'ing tens of thousands of files on Lustre takes minutes, so the
+    results are kept in cache_file, per directory, and used again as
+    long as the directory's mtime is the same (adding, removing or
+    renaming files changes it, rewriting one in place doesn't: use
+    rescan).  lines is the number of lines of the file, from its sidecar
+    index or from known_lines (loaded_files), or None if not known yet.
+    Missing files raise FileNotFoundError.
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            cache = json.loads(f.read())
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = { }
+    by_dir = collections.defaultdict(list)
+    for file_ in files:
+        by_dir[os.path.dirname(file_)].append(file_)
+    manifest, changed = { }, False
+    for dir_, dir_files in by_dir.items():
+        mtime_ns = os.stat(dir_).st_mtime_ns
+        entry = cache.get(dir_)
+        if rescan or entry is None or entry['mtime_ns'] != mtime_ns:
+            entry = cache[dir_] = { 'mtime_ns': mtime_ns, 'files': { } }
+        for file_ in dir_files:
+            name = os.path.basename(file_)
+            if name not in entry['files']:
+                stat = os.stat(file_)
+                index = zst.load_index(file_) if os.path.exists(zst.index_name(file_)) else None
+                entry['files'][name] = [ stat.st_size, stat.st_mtime_ns, index['lines'] if index else None ]
+                changed = True
+            if entry['files'][name][2] is None and file_ in known_lines:
+                entry['files'][name][2] = known_lines[file_]
+                changed = True
+            manifest[file_] = entry['files'][name]
+    if changed:
+        # Shards may write at the same time: each replaces the whole file
+        with open(f'{cache_file}.{os.getpid()}.tmp', 'wb') as f:
+            f.write(json.dumps(cache))
+        os.replace(f'{cache_file}.{os.getpid()}.tmp', cache_file)
+    return manifest
+
+
+def estimated_lines(manifest, files):
+    """Lines of files: known, or estimated from the lines per byte of the files with known lines"""
+    known = [ x for x in manifest.values() if x[2] ]
+    per_byte = sum(x[2] for x in known) / max(sum(x[0] for x in known), 1) if known else None
+    if per_byte is None:
+        return None
+    return sum(manifest[f][2] or int(manifest[f][0] * per_byte) for f in files)
+
+
+known_lines = dict(conn.execute('SELECT file, lines FROM loaded_files WHERE lines IS NOT NULL').fetchall())
+manifest = file_manifest(args.files, files_cache, known_lines, args.rescan_files)
+
+
+def shard_files(files, k, n):
+    """Return the files of shard k out of n, balanced by compressed bytes
+
+    Largest files first, each to the currently smallest shard.  This is
+    deterministic, so every array task computes the same split.
+    """
+    shards = [ [0, [ ]] for _ in range(n) ]
+    for size, file_ in sorted(((manifest[f][0], f) for f in files), reverse=True):
+        smallest = min(shards, key=lambda x: x[0])
+        smallest[0] += size
+        smallest[1].append(file_)
+    return shards[k][1]
+if shard is not None:
+    args.files = shard_files(args.files, *shard)
+    print(f"Shard {shard[0]}/{shard[1]}: {len(args.files)} files")
+
+
+# Resume: skip loaded files, and the committed chunks of partially loaded files
+loaded_files = { x[0] for x in conn.execute('SELECT file FROM loaded_files').fetchall() }
+loaded_chunks = collections.defaultdict(list)
+for file_, chunk_start, chunk_stop in conn.execute('SELECT file, start, stop FROM loaded_chunks ORDER BY file, start').fetchall():
+    loaded_chunks[file_].append((chunk_start, chunk_stop))
+lines_done = collections.Counter({ file_: sum(b - a for a, b in chunks) for file_, chunks in loaded_chunks.items() })
+n_loaded = sum(1 for file_ in args.files if file_ in loaded_files)
+n_partial = sum(1 for file_ in args.files if file_ in loaded_chunks)
+args.files = [ file_ for file_ in args.files if file_ not in loaded_files ]
+if n_loaded or n_partial:
+    print(f"Resuming: files already loaded: {n_loaded}, partially loaded: {n_partial}")
+
+
+# --format=parquet: publish the files of committed ranges, and remove
+# the others: their lines are loaded again
+if args.format == 'parquet':
+    parquetsink.publish([ os.path.join(args.db, x[0]) for x in conn.execute('SELECT path FROM parquet_pending') ])
+    conn.execute('DELETE FROM parquet_pending')
+    conn.commit()
+    parquetsink.remove_partial(os.path.join(args.db, TABLE))
 
 
 # Status variables for our progress
 
-bytes_total = sum(os.stat(file_).st_size for file_ in args.files)
+bytes_total = sum(manifest[file_][0] for file_ in args.files)
+lines_estimate = estimated_lines(manifest, args.files)
+print(f"Files: {len(args.files)}, {bytes_total/2**30:.1f} GiB"
+      + (f", about {lines_estimate:,} lines" if lines_estimate is not None else ""))
 bytes_processed = multiprocessing.Value(ctypes.c_long, 0)
 lines_total = multiprocessing.Value(ctypes.c_long, 0)
 lines_bad = multiprocessing.Value(ctypes.c_long, 0)
+lines_dup = multiprocessing.Value(ctypes.c_long, 0)
 n_decode = multiprocessing.Value(ctypes.c_long, 0)
 n_insert = multiprocessing.Value(ctypes.c_long, 0)
+# Per stage: lines done (bad lines included), and compressed bytes read
+stage_lines = { stage: multiprocessing.Value(ctypes.c_long, 0) for stage in latency }
+bytes_read = multiprocessing.Value(ctypes.c_long, 0)
 start = time.time()
 def runtime():
     return time.time() - start
 
+def text_samples(files, n_files=200, lines_per_file=1000):
+    """Return { column: [ values ] } of the text columns in the first lines of up to n_files of files"""
+    samples = { col: [ ] for col in TEXT_COLUMNS }
+    for file_ in files[::max(len(files) // n_files, 1)]:
+        for lines, _ in zst.read_line_batches_zst(file_, chunk_size=2**22):
+            for line in lines[:lines_per_file]:
+                try:
+                    obj = json.loads(line)
+                    for col in TEXT_COLUMNS:
+                        if isinstance(obj.get(col), str) and obj[col]:
+                            samples[col].append(obj[col])
+                except (ValueError, TypeError, AttributeError):
+                    pass
+            break
+    return samples
+
+
+# --compress-text: compress each text column with its dictionary in DB, or train one first
+if args.compress_text and any(col[0] in TEXT_COLUMNS for col in COLUMNS):
+    samples = None
+    compressors = { }
+    for name in (col[0] for col in COLUMNS if col[0] in TEXT_COLUMNS):
+        text_dict = zst.text_dict(conn, TABLE, name)
+        if text_dict is None:
+            dict_start = time.time()
+            if samples is None:
+                samples = text_samples(args.files)
+            try:
+                text_dict = zst.train_text_dict(samples[name])
+                zst.save_text_dict(conn, text_dict, TABLE, name)
+                conn.commit()
+                print(f"Trained zstd dictionary of {len(text_dict):,} bytes for {TABLE}.{name} on "
+                      f"{len(samples[name]):,} values in {time.time()-dict_start:.1f} s")
+            except zstandard.ZstdError as err:
+                # Too few samples: compress without a dictionary
+                print(f"No zstd dictionary for {TABLE}.{name} ({err})")
+        compressors[name] = zst.text_compressor(text_dict, level=args.compress_level)
+    def compressed(name):
+        compress_text = compressors[name]
+        return lambda obj: compress_text(obj.get(name))
+    COLUMNS = [ (col[0], col[1], compressed(col[0])) if col[0] in TEXT_COLUMNS else col for col in COLUMNS ]
+
+# --append: ids already in the database are skipped by the decoders
+ID_COL = [ col[0] for col in COLUMNS ].index('id')
+KEY_COLS = [ [ col[0] for col in COLUMNS ].index(name) for name in ('subreddit', 'created_utc', 'id') ]
+known_ids = existing_ids(conn) if args.append else None
+
+def profiled(target, stage):
+    """With --profile, wrap a process target to run under cProfile
+
+    Each process writes PROFILE/STAGE-PID.prof when target returns
+    (a process that is killed writes nothing).
+    """
+    if not args.profile:
+        return target
+    def run(*args_):
+        prof = cProfile.Profile()
+        try:
+            prof.runcall(target, *args_)
+        finally:
+            prof.dump_stats(os.path.join(args.profile, f'{stage}-{os.getpid()}.prof'))
+    return run
+if args.profile:
+    os.makedirs(args.profile, exist_ok=True)
+
+# The inserter opens DuckDB again: connections can't cross fork()
+if args.format == 'duckdb':
+    conn.close()
+
 # Queues
 queue1 = multiprocessing.Queue(maxsize=10)
 queue2 = multiprocessing.Queue(maxsize=10)
+# Shared memory for the data, then the queues only carry descriptors
+ring1 = ring2 = None
+if args.shm_mb:
+    ring1 = shmring.ShmRing(10 + max(args.readers, args.max_procs if args.autoscale else 0), args.shm_mb * 2**20)
+    ring2 = shmring.ShmRing(10 + max(args.decoders, args.max_procs if args.autoscale else 0), args.shm_mb * 2**20)
 
 # start decoding process
-decode_ps = [ multiprocessing.Process(target=decode, args=(queue1, queue2,)) for _ in range(args.decoders) ]
-for p in decode_ps:
+decode_ps = [ ]
+n_decoders = 0
+def start_decoder():
+    global n_decoders
+    p = multiprocessing.Process(target=profiled(decode, 'decode'), args=(queue1, queue2,))
     p.start()
+    decode_ps.append(p)
+    n_decoders += 1
+def stop_decoder():
+    """The first decoder to get this sentinel stops"""
+    global n_decoders
+    queue1.put('DONE')
+    n_decoders -= 1
+for _ in range(args.decoders):
+    start_decoder()
 
 # start inserting process
-insert_p = multiprocessing.Process(target=insert, args=(queue2,))
+insert_p = multiprocessing.Process(target=profiled(insert, 'insert'), args=(queue2,))
 insert_p.start()
 
 
-# For every file, via multiprocessing.Pool
+# For every file, via reader processes taking tasks from a queue
 #p_read = multiprocessing.Process(target=read, args=(queue1, file_))
-read_pool = multiprocessing.Pool(processes=args.readers)
-read_pool.map(read, args.files)
-read_pool.close()
-read_pool.join()
+# Files with an up-to-date sidecar index can be split into frame ranges.
+tasks = [ ]
+for file_ in args.files:
+    index = zst.load_index(file_) if args.split_bytes else None
+    if index and len(index['frames']) > 1:
+        tasks.extend((size, (file_, start, stop, loaded_chunks[file_]))
+                     for start, stop, size in zst.split_ranges(index, args.split_bytes))
+    else:
+        tasks.append((manifest[file_][0], (file_, 0, None, loaded_chunks[file_])))
+# Largest first: readers take the next task when done with one, so the
+# small ones fill in at the end, instead of one large file running alone
+tasks.sort(key=lambda x: x[0], reverse=True)
+task_queue = multiprocessing.Queue()
+for _, task in tasks:
+    task_queue.put(task)
+tasks_taken = multiprocessing.Value(ctypes.c_long, 0)
+
+def read_worker(task_queue, stop):
+    """Reader process: read tasks until 'DONE', or until told to stop"""
+    while not stop.is_set():
+        task = task_queue.get()
+        if task == 'DONE':
+            break
+        with tasks_taken.get_lock():
+            tasks_taken.value += 1
+        read(task)
+
+readers = [ ]
+def start_reader():
+    stop = multiprocessing.Event()
+    p = multiprocessing.Process(target=profiled(read_worker, 'read'), args=(task_queue, stop))
+    p.start()
+    readers.append((p, stop))
+    # One sentinel per reader, after all the tasks
+    task_queue.put('DONE')
+def running_readers():
+    return [ (p, stop) for p, stop in readers if p.is_alive() and not stop.is_set() ]
+for _ in range(args.readers):
+    start_reader()
+
+
+def autoscale():
+    """Move the number of readers and decoders one step toward keeping the inserter busy
+
+    Per process, a stage handles 1/time_STAGE.avg chunks per second,
+    so the single inserter needs time_read/time_insert readers and
+    time_decode/time_insert decoders.  Queue depths correct this: a
+    full queue2 means the inserter is saturated already, a full queue1
+    means decoders are missing, and both empty means readers are.  If
+    more than --max-procs are wanted, the processes are taken from the
+    stage that isn't missing.
+    """
+    if any(math.isnan(x.avg) for x in (time_read, time_decode, time_insert)):
+        return
+    q1, q2 = queue1.qsize(), queue2.qsize()
+    n_readers = len(running_readers())
+    want_readers = math.ceil(time_read.avg / time_insert.avg)
+    want_decoders = math.ceil(time_decode.avg / time_insert.avg)
+    if q2 >= 8:
+        want_decoders = min(want_decoders, n_decoders)
+    if q1 >= 8:
+        want_readers = min(want_readers, n_readers)
+        want_decoders = max(want_decoders, n_decoders + 1)
+    if q1 <= 1 and q2 <= 1:
+        want_readers = max(want_readers, n_readers + 1)
+    want_readers = max(want_readers, 1)
+    if tasks_taken.value >= len(tasks):
+        # Nothing left for a new reader to do
+        want_readers = min(want_readers, n_readers)
+    want_decoders = max(want_decoders, 1)
+    excess = want_readers + want_decoders - args.max_procs
+    if excess > 0:
+        if q1 >= 8:
+            # Decoders are missing: fewer readers first
+            fewer = min(excess, want_readers - 1)
+            want_readers, want_decoders = want_readers - fewer, want_decoders - (excess - fewer)
+        else:
+            fewer = min(excess, want_decoders - 1)
+            want_readers, want_decoders = want_readers - (excess - fewer), want_decoders - fewer
+    if want_readers == n_readers and want_decoders == n_decoders:
+        return
+    print(f"autoscale: queues {q1} {q2}, readers {n_readers} -> {want_readers}, decoders {n_decoders} -> {want_decoders}")
+    # Shrink first, then grow, to stay within --max-procs
+    if want_readers < n_readers:
+        running_readers()[-1][1].set()
+    if want_decoders < n_decoders:
+        stop_decoder()
+    if want_readers > n_readers:
+        start_reader()
+    if want_decoders > n_decoders:
+        start_decoder()
+
+
+def rss(pid):
+    """Resident memory of process pid in bytes, or None without /proc"""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+metrics_last = { 'time': start }
+def write_metrics(final=False):
+    """Append one JSON line of metrics to --metrics
+
+    Counts and histograms are totals since the start; lines_per_s and
+    utilization are since the previous record.  Utilization is the
+    fraction of the time the processes of a stage spent on chunks
+    (excluding waiting for the queues): the stage near 1 is the one
+    limiting the others.  It is divided by the most running processes
+    at either end of the interval, and null if there were none at both.
+    """
+    now = time.time()
+    interval = max(now - metrics_last['time'], 1e-9)
+    procs = { 'read': len(running_readers()), 'decode': sum(p.is_alive() for p in decode_ps),
+              'insert': int(insert_p.is_alive()) }
+    stages = { }
+    for stage, hist in latency.items():
+        lines, busy = stage_lines[stage].value, hist.total.value
+        last_lines, last_busy, last_procs = metrics_last.get(stage, (0, 0., procs[stage]))
+        stages[stage] = {
+            'procs': procs[stage],
+            'chunks': sum(hist.counts),
+            'lines': lines,
+            'lines_per_s': (lines - last_lines) / interval,
+            'busy_s': busy,
+            'utilization': (busy - last_busy) / interval / max(procs[stage], last_procs)
+                           if max(procs[stage], last_procs) else None,
+            'latency_s': hist.buckets(),
+            }
+        metrics_last[stage] = lines, busy, procs[stage]
+    pids = { 'main': [ os.getpid() ],
+             'read': [ p.pid for p, _ in readers if p.is_alive() ],
+             'decode': [ p.pid for p in decode_ps if p.is_alive() ],
+             'insert': [ insert_p.pid ] if insert_p.is_alive() else [ ] }
+    record = {
+        'time': now,
+        'runtime': now - start,
+        'final': final,
+        'table': TABLE,
+        'queues': { 'decode': queue1.qsize(), 'insert': queue2.qsize() },
+        'stages': stages,
+        'bytes_read': bytes_read.value,
+        'bytes_read_per_s': (bytes_read.value - metrics_last.get('bytes_read', 0)) / interval,
+        'bytes_total': bytes_total,
+        'lines_bad': lines_bad.value,
+        'lines_dup': lines_dup.value,
+        'rss': { role: sum(filter(None, map(rss, p))) for role, p in pids.items() },
+        }
+    metrics_last['bytes_read'] = bytes_read.value
+    metrics_last['time'] = now
+    with open(args.metrics, 'ab') as f:
+        f.write(json.dumps(record) + b'\n')
+
+
+last_scale = last_metrics = time.time()
+while any(p.is_alive() for p, _ in readers):
+    time.sleep(1)
+    if args.autoscale and time.time() - last_scale >= args.autoscale:
+        autoscale()
+        last_scale = time.time()
+    if args.metrics and time.time() - last_metrics >= args.metrics_every:
+        write_metrics()
+        last_metrics = time.time()
+for p, _ in readers:
+    p.join()
+    if p.exitcode != 0:
+        print(f"reader {p.pid} failed (exit code {p.exitcode}), rerun to load what is missing")
 print("reading: done")
 
 # Close all decoders
-for _ in range(args.decoders):
+for _ in range(n_decoders):
     queue1.put('DONE')
 queue1.close()
 for p in decode_ps:
@@ -431,7 +1654,18 @@ for p in decode_ps:
 queue2.put('DONE')
 insert_p.join()
 
-conn.execute('PRAGMA journal_mode = delete;')
+if args.metrics:
+    write_metrics(final=True)
+
+if args.format != 'duckdb':
+    conn.execute('PRAGMA journal_mode = delete;')
+if args.shm_mb:
+    ring1.unlink()
+    ring2.unlink()
 
+if args.append:
+    print(f"Rows skipped as already present: {lines_dup.value:,}")
+if args.profile:
+    print(f"Profiles: {args.profile}/{{read,decode,insert}}-PID.prof")
 print(f"Total walltime: {runtime()} s")
 print(f"Total process time (user+sys): {sum(os.times()[:4])} s") # user+child processes
@@ -0,0 +1,133 @@
+"""Write rows into a Hive-partitioned Parquet dataset
+
+Layout: ROOT/subreddit=SUB/year=YEAR/part-TIME-PID-N.parquet, with the
+columns of COLUMNS (see load-queue.py) except subreddit, which is in
+the path.  Each file is sorted by created_utc, so the row group
+statistics let readers skip by time, too.  Readers like DuckDB
+(read_parquet('ROOT/**/*.parquet', hive_partitioning=true)), pyarrow,
+pandas and polars then read only the partitions and columns they need.
+
+arrow_table makes the typed Arrow tables, also for --format=duckdb.
+"""
+
+import collections
+import glob
+import os
+import time
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+ARROW_TYPES = {
+    'TEXT': pa.string(),
+    'INTEGER': pa.int64(),
+    }
+# Partition value of NULLs, as Hive and pyarrow write it
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def to_int(x):
+    """Integer value of x (bools, floats and numeric strings too), else None"""
+    try:
+        return int(x)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_str(x):
+    """String value of x, for TEXT columns that have something else"""
+    return x if x is None or isinstance(x, str) else str(x)
+
+
+def arrow_column(values, type_):
+    """Arrow array of values, converting those that don't fit type_"""
+    try:
+        return pa.array(values, type_)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        convert = to_int if type_ == pa.int64() else to_str
+        return pa.array([ convert(x) for x in values ], type_)
+
+
+def arrow_table(rows, columns, skip=()):
+    """Arrow table of rows (tuples in the order of columns), without the columns in skip"""
+    keep = [ (i, col[0], ARROW_TYPES[col[1]]) for i, col in enumerate(columns) if col[0] not in skip ]
+    return pa.Table.from_arrays([ arrow_column([ row[i] for row in rows ], type_) for i, _, type_ in keep ],
+                                schema=pa.schema([ (name, type_) for _, name, type_ in keep ]))
+
+
+def tmp_name(path):
+    """Name of the part file path until it is published"""
+    return os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+
+
+def publish(paths):
+    """Rename the written part files paths to their final names (skipping those already renamed)"""
+    for path in paths:
+        try:
+            os.rename(tmp_name(path), path)
+        except FileNotFoundError:
+            if not os.path.exists(path):
+                raise
+
+
+def remove_partial(root):
+    """Remove the temporary files that weren't published: interrupted writes, and rows not checkpointed"""
+    for name in glob.glob(os.path.join(root, '**', '.*.tmp'), recursive=True):
+        os.unlink(name)
+
+
+class PartitionedWriter:
+    """Buffer rows by (subreddit, year) and write each buffer as one Parquet file
+
+    add() rows until full(), then flush() writes all buffers under
+    temporary names, which publish() renames once the rows are
+    committed (see insert() of load-queue.py).  Only one process should
+    use a writer; file names include the start time and pid, so many
+    processes and runs can write into the same root.
+    """
+    def __init__(self, root, columns, max_rows=250000, compression='zstd'):
+        self.root = root
+        self.columns = columns
+        names = [ col[0] for col in columns ]
+        self.sub_col = names.index('subreddit')
+        self.time_col = names.index('created_utc')
+        names.remove('subreddit')
+        self.sorting = [ pq.SortingColumn(names.index('created_utc')) ]
+        self.max_rows = max_rows
+        self.compression = compression
+        self.buffers = collections.defaultdict(list)
+        self.n_rows = 0
+        self.n_files = 0
+        self.started = int(time.time())
+
+    def add(self, rows):
+        sub_col, time_col = self.sub_col, self.time_col
+        gmtime = time.gmtime
+        for row in rows:
+            t = to_int(row[time_col])
+            self.buffers[row[sub_col], None if t is None else gmtime(t).tm_year].append(row)
+        self.n_rows += len(rows)
+
+    def full(self):
+        return self.n_rows >= self.max_rows
+
+    def flush(self):
+        """Write all buffered rows as temporary files, return their final paths"""
+        paths = [ ]
+        time_col = self.time_col
+        for (sub, year), rows in self.buffers.items():
+            rows.sort(key=lambda row: (row[time_col] is None, to_int(row[time_col]) or 0))
+            table = arrow_table(rows, self.columns, skip=('subreddit', ))
+            dirname = os.path.join(self.root,
+                                   f'subreddit={NULL_PARTITION if sub is None else quote(sub, safe="")}',
+                                   f'year={NULL_PARTITION if year is None else year}')
+            os.makedirs(dirname, exist_ok=True)
+            path = os.path.join(dirname, f'part-{self.started}-{os.getpid()}-{self.n_files}.parquet')
+            self.n_files += 1
+            pq.write_table(table, tmp_name(path), compression=self.compression, sorting_columns=self.sorting)
+            paths.append(path)
+        self.buffers.clear()
+        self.n_rows = 0
+        return paths
@@ -0,0 +1,52 @@
+import multiprocessing
+from multiprocessing import shared_memory
+
+
+class ShmRing:
+    """A ring of fixed-size shared memory slots for passing chunks between processes
+
+    Only (slot, nbytes) descriptors need to go through a
+    multiprocessing.Queue: the writer copies its data into a free slot,
+    the reader copies it back out and releases the slot.  Free slots
+    are handed out through a queue, so writers block (like a full
+    Queue) once all slots are in flight.
+
+    This relies on the fork start method: create the ring before
+    starting the processes that use it, and unlink() it at the end.
+    """
+    def __init__(self, n_slots, slot_bytes):
+        self.slot_bytes = slot_bytes
+        self.slots = [ shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(n_slots) ]
+        self.free = multiprocessing.Queue()
+        for slot in range(n_slots):
+            self.free.put(slot)
+
+    def put(self, parts, nbytes=None):
+        """Copy the concatenation of parts into a free slot, return its descriptor
+
+        Returns None if the data doesn't fit into one slot: the caller
+        then has to send it some other way.
+        """
+        if nbytes is None:
+            nbytes = sum(len(part) for part in parts)
+        if nbytes > self.slot_bytes:
+            return None
+        slot = self.free.get()
+        buf = self.slots[slot].buf
+        offset = 0
+        for part in parts:
+            buf[offset:offset+len(part)] = part
+            offset += len(part)
+        return slot, nbytes
+
+    def get(self, descriptor):
+        """Return the bytes of a slot and release it"""
+        slot, nbytes = descriptor
+        data = bytes(self.slots[slot].buf[:nbytes])
+        self.free.put(slot)
+        return data
+
+    def unlink(self):
+        for shm in self.slots:
+            shm.close()
+            shm.unlink()
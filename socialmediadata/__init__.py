@@ -0,0 +1,10 @@
+"""Python access to the databases made by load-queue.py
+
+Import it with this repository in sys.path (for zst.py).
+"""
+
+from .access import Database, connect, iter_rows, iter_comments, iter_submissions, search
+from .cache import QueryCache, read_sql
+from .graph import ReplyGraph, reply_graph
+from .parallel import iter_parallel, query_parallel
+from .router import query_years
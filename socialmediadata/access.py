@@ -0,0 +1,220 @@
+"""Read rows of subreddits and time ranges in fixed-size batches
+
+    import socialmediadata as smd
+    for batch in smd.iter_comments('db.sqlite3', ['aaa', 'bbbbb'], '2020-10-01', '2020-11-01',
+                                   columns=['author', 'created_utc', 'score']):
+        ...   # batch['score'] is a NumPy array of at most batch_size values
+
+Each subreddit is one query of subreddit = ? AND created_utc in
+[start, end), which SQLite answers from the (subreddit, created_utc)
+index (or the table itself, for --cluster databases), in time order.
+Rows are fetched with fetchmany, so memory use is bounded by the batch
+size, not the size of the subreddit.
+"""
+
+from datetime import datetime, timezone
+import os
+import sqlite3
+
+import numpy as np
+
+import zst
+
+from . import hll
+
+
+BATCH_SIZE = 100000
+
+# path: Database, so that each database is opened only once per process
+_databases = { }
+
+
+def connect(path):
+    """Return the Database of path, opened read-only once per process
+
+    It is opened again if the file was replaced or changed since, and in
+    forked processes (a connection must not be used in two processes).
+    """
+    if isinstance(path, Database):
+        return path
+    path = os.path.abspath(path)
+    db = _databases.get(path)
+    if db is not None and db.pid != os.getpid():
+        db = None
+    if db is not None and db.identity != db_identity(path):
+        db.close()
+        db = None
+    if db is None:
+        db = _databases[path] = Database(path)
+    return db
+
+
+def db_identity(path):
+    """What changes when the file at path is written or replaced: path, inode, size and mtime"""
+    stat = os.stat(path)
+    return { 'db': path, 'inode': stat.st_ino, 'file_size': stat.st_size, 'mtime_ns': stat.st_mtime_ns }
+
+
+class Database:
+    """A read-only connection to a load-queue.py database, and its column types
+
+    Works the same on plain, --normalize (through the views), --cluster
+    and --compress-text databases, and has the SQL functions of hll.  The
+    file must not change while it is open: the connection is
+    immutable=1, so SQLite doesn't lock it.
+    """
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.path = path
+        self.identity = db_identity(path)
+        self.pid = os.getpid()
+        self.conn = sqlite3.connect(f'file:{path}?immutable=1&mode=ro', uri=True, check_same_thread=False)
+        zst.register_sqlite(self.conn)
+        hll.register_sqlite(self.conn)
+        # table: {column: declared type}
+        self.columns = { }
+        for (table, ) in self.conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') "
+                                           "AND name IN ('comments', 'submissions')").fetchall():
+            self.columns[table] = { x[1]: x[2] or 'TEXT' for x in self.conn.execute(f'PRAGMA table_info({table})') }
+        # Normalized databases: the views' types are those of the data tables
+        for table, cols in self.columns.items():
+            for col, type_ in self.conn.execute(f"SELECT name, type FROM pragma_table_info('{table}_data')"):
+                if col in cols:
+                    cols[col] = type_
+        # table: SQL condition of the rows matching the FTS5 query :match (see make_fts of load-queue.py)
+        self.fts = { }
+        names = { x[0] for x in self.conn.execute("SELECT name FROM sqlite_master") }
+        for table in self.columns:
+            fts = f'{table}_fts'
+            if fts not in names:
+                continue
+            rowids = f'SELECT rowid FROM {fts} WHERE {fts} MATCH :match'
+            if f'{fts}_ids' in names:
+                self.fts[table] = f'id IN (SELECT id FROM {fts}_ids WHERE rowid IN ({rowids}))'
+            elif f'{table}_data' in names:
+                self.fts[table] = f'id IN (SELECT id FROM {table}_data WHERE rowid IN ({rowids}))'
+            else:
+                self.fts[table] = f'rowid IN ({rowids})'
+
+    def close(self):
+        self.conn.close()
+        _databases.pop(self.path, None)
+
+    def __repr__(self):
+        return f'<Database {self.path}: {", ".join(self.columns)}>'
+
+
+def timestamp(t):
+    """Unix time of t: a number, a datetime (naive is UTC) or an ISO date string"""
+    if t is None or isinstance(t, (int, float, np.integer, np.floating)):
+        return t
+    if isinstance(t, str):
+        t = datetime.fromisoformat(t)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return t.timestamp()
+
+
+def numpy_batch(rows, columns, types):
+    """{column: NumPy array}.  Integers with NULLs become float64 with NaN, text is object"""
+    batch = { }
+    for i, col in enumerate(columns):
+        values = [ row[i] for row in rows ]
+        if types[col] == 'INTEGER':
+            try:
+                batch[col] = np.array(values, dtype=np.int64)
+                continue
+            except (TypeError, ValueError):
+                try:
+                    batch[col] = np.array([ np.nan if x is None else x for x in values ], dtype=np.float64)
+                    continue
+                except (TypeError, ValueError):
+                    pass
+        batch[col] = np.array(values, dtype=object)
+    return batch
+
+
+def arrow_batch(rows, columns, types):
+    """pyarrow.Table of the rows"""
+    import parquetsink
+    return parquetsink.arrow_table(rows, [ (col, 'INTEGER' if types[col] == 'INTEGER' else 'TEXT') for col in columns ])
+
+
+FORMATS = {
+    'numpy': numpy_batch,
+    'arrow': arrow_batch,
+    'rows': lambda rows, columns, types: rows,
+    }
+
+
+def iter_rows(db, table, subreddits=None, start=None, end=None, columns=None,
+              batch_size=BATCH_SIZE, format='numpy', match=None, order=True):
+    """Yield the rows of table in subreddits with start <= created_utc < end, in batches
+
+    db is a path or a Database.  subreddits is a name, a list of names,
+    or None for all (which scans by time only).  Only the given columns
+    are read (default: all).  Each batch has batch_size rows, except
+    the last, and is a {column: array} dict (format='numpy'), a
+    pyarrow.Table ('arrow') or a list of tuples ('rows').  Rows are in
+    the order of subreddits, then created_utc; order=False leaves out
+    the sorting by created_utc, so that reading all rows is one scan of
+    the table.  match is an FTS5 query (like 'climate NEAR change'), for
+    databases made with --fts.
+    """
+    db = connect(db)
+    if table not in db.columns:
+        raise ValueError(f"{db.path} has no table {table}")
+    types = db.columns[table]
+    columns = list(types) if columns is None else list(columns)
+    unknown = [ col for col in columns if col not in types ]
+    if unknown:
+        raise ValueError(f"{table} has no columns {unknown}")
+    make_batch = FORMATS[format]
+    if isinstance(subreddits, str):
+        subreddits = [ subreddits ]
+
+    select = ', '.join(f'zstd_decompress({col}) AS {col}' if types[col] == 'ZSTD' else col for col in columns)
+    # Plain comparisons of the columns, so that the index can be used
+    where, params = [ ], { 'start': timestamp(start), 'end': timestamp(end), 'match': match }
+    if subreddits is not None:
+        where.append('subreddit = :sub')
+    if start is not None:
+        where.append('created_utc >= :start')
+    if end is not None:
+        where.append('created_utc < :end')
+    if match is not None:
+        if table not in db.fts:
+            raise ValueError(f"{db.path} has no full-text index of {table} (load-queue.py --fts)")
+        where.append(db.fts[table])
+    sql = f'SELECT {select} FROM {table}' + (f' WHERE {" AND ".join(where)}' if where else '') \
+        + (' ORDER BY created_utc' if order else '')
+
+    rows = [ ]
+    for sub in (subreddits if subreddits is not None else [ None ]):
+        cursor = db.conn.execute(sql, dict(params, sub=sub))
+        while True:
+            new = cursor.fetchmany(batch_size - len(rows))
+            if not new:
+                break
+            rows.extend(new)
+            if len(rows) == batch_size:
+                yield make_batch(rows, columns, types)
+                rows = [ ]
+    if rows:
+        yield make_batch(rows, columns, types)
+
+
+def search(db, match, table='comments', subreddits=None, start=None, end=None, columns=None, **kwargs):
+    """iter_rows of the rows of table that match the FTS5 query match"""
+    return iter_rows(db, table, subreddits, start, end, columns, match=match, **kwargs)
+
+
+def iter_comments(db, subreddits=None, start=None, end=None, columns=None, **kwargs):
+    """iter_rows of the comments table"""
+    return iter_rows(db, 'comments', subreddits, start, end, columns, **kwargs)
+
+
+def iter_submissions(db, subreddits=None, start=None, end=None, columns=None, **kwargs):
+    """iter_rows of the submissions table"""
+    return iter_rows(db, 'submissions', subreddits, start, end, columns, **kwargs)
@@ -0,0 +1,159 @@
+"""Cache of query results as Parquet files, shared by processes
+
+    import socialmediadata as smd
+    df = smd.read_sql("SELECT subreddit, count(*) FROM comments GROUP BY subreddit", DB)
+
+The first run queries DB and saves the result; later runs, in any
+process, read the saved result instead, as long as DB is the same file
+(db_identity: rebuilding it and mv'ing it into place makes a new one).
+The cache key is the database path and identity, the SQL with
+whitespace normalized, and the parameters.  Results of an older
+identity of the same database are deleted when a new one is saved.
+
+Files are DIR/PATHKEY-IDENTITYKEY-QUERYKEY.parquet (zstd compressed),
+written under a temporary name and renamed, so readers only see
+complete files.  A hit sets the mtime of its file, and when the cache
+is over max_bytes the files with the oldest mtimes are deleted (under
+an flock of DIR/.lock, so that only one process does it at a time).
+DIR is $SMD_QUERY_CACHE, or $WRKDIR/socialmediadata-cache (scratch on
+Triton), or ~/.cache/socialmediadata.
+"""
+
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .access import Database, connect, db_identity
+
+
+MAX_BYTES = 20 * 2**30
+
+
+def default_dir():
+    if 'SMD_QUERY_CACHE' in os.environ:
+        return os.environ['SMD_QUERY_CACHE']
+    if 'WRKDIR' in os.environ:
+        return os.path.join(os.environ['WRKDIR'], 'socialmediadata-cache')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'socialmediadata')
+
+
+def normalize_sql(sql):
+    """sql with runs of whitespace outside of quotes made one space, and no trailing ;"""
+    parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", sql)
+    parts[::2] = [ re.sub(r'\s+', ' ', part) for part in parts[::2] ]
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def short_hash(x):
+    return hashlib.sha256(json.dumps(x, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def arrow_result(cursor):
+    """pyarrow.Table of all rows of a cursor, columns of mixed types as text"""
+    return arrow_rows([ x[0] for x in cursor.description ], cursor.fetchall())
+
+
+def arrow_rows(names, rows):
+    """pyarrow.Table of the rows (tuples), columns of mixed types as text"""
+    columns = [ ]
+    for i in range(len(names)):
+        values = [ row[i] for row in rows ]
+        try:
+            columns.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            columns.append(pa.array([ None if x is None else str(x) for x in values ], pa.string()))
+    return pa.Table.from_arrays(columns, names=names)
+
+
+class QueryCache:
+    def __init__(self, cache_dir=None, max_bytes=MAX_BYTES):
+        self.dir = cache_dir or default_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.dir, exist_ok=True)
+
+    def locked(self):
+        """A file object holding the cache's exclusive flock until closed"""
+        f = open(os.path.join(self.dir, '.lock'), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def path(self, db_path, identity, sql, params):
+        return os.path.join(self.dir, f'{short_hash(db_path)}-{short_hash(identity)}-'
+                                      f'{short_hash([ normalize_sql(sql), params ])}.parquet')
+
+    def get(self, path):
+        """The saved table of path, or None"""
+        try:
+            table = pq.read_table(path)
+            os.utime(path)
+        except FileNotFoundError:
+            # Not there, or evicted just now
+            return None
+        return table
+
+    def put(self, path, table):
+        db_key, identity_key = os.path.basename(path).split('-')[:2]
+        tmp = os.path.join(self.dir, f'.{os.path.basename(path)}.{os.getpid()}.tmp')
+        pq.write_table(table, tmp, compression='zstd')
+        os.replace(tmp, path)
+        with self.locked():
+            # Results of a database that has since been replaced
+            for name in glob.glob(os.path.join(self.dir, f'{db_key}-*.parquet')):
+                if not os.path.basename(name).startswith(f'{db_key}-{identity_key}-'):
+                    self.remove(name)
+            self.evict()
+
+    def remove(self, name):
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Delete the least recently used files until the cache is at most max_bytes"""
+        files = [ ]
+        for name in glob.glob(os.path.join(self.dir, '*.parquet')):
+            try:
+                stat = os.stat(name)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(x[1] for x in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self.remove(name)
+            total -= size
+
+    def query(self, db, sql, params=()):
+        """pyarrow.Table of the result of sql on db, from the cache if it is there"""
+        db_path = db.path if isinstance(db, Database) else os.path.abspath(db)
+        params = dict(params) if isinstance(params, dict) else list(params)
+        # A hit doesn't need to open the database
+        path = self.path(db_path, db_identity(db_path), sql, params)
+        table = self.get(path)
+        if table is None:
+            table = arrow_result(connect(db_path).conn.execute(sql, params))
+            self.put(path, table)
+        return table
+
+    def clear(self):
+        with self.locked():
+            for name in glob.glob(os.path.join(self.dir, '*.parquet')):
+                self.remove(name)
+
+
+def query(sql, db, params=(), cache_dir=None, max_bytes=MAX_BYTES):
+    """pyarrow.Table of the result of sql on db, cached"""
+    return QueryCache(cache_dir, max_bytes).query(db, sql, params)
+
+
+def read_sql(sql, db, params=(), cache_dir=None, max_bytes=MAX_BYTES):
+    """Like pandas.read_sql(sql, conn, params=params), but cached: db is the path of the database"""
+    return query(sql, db, params, cache_dir, max_bytes).to_pandas()
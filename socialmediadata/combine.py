@@ -0,0 +1,219 @@
+"""Combining the results of one query run on parts of the data
+
+A query like
+
+    SELECT subreddit, count(*), sum(score), max(created_utc) FROM comments GROUP BY subreddit
+
+run on each part (year databases, time ranges, ...) gives partial rows
+that are combined by their group (the columns that aren't aggregates):
+counts and sums are added, minimums and maximums taken again, and
+HyperLogLog sketches (hll_union) united.  Aggregates are known by the
+column names SQLite gives them, when the column is one call like
+'count(*)'.  Columns renamed with AS must be given in merge, like
+merge={'n': 'sum'}, and expressions with aggregates in them, like
+'sum(score)*1.0/count(*)', raise ValueError unless they are in merge.
+avg() and count(DISTINCT ...) can't be combined from parts: select
+sum() and count(), or hll_union of hll sketches, instead.  Queries
+without aggregates are concatenated.
+
+ORDER BY, LIMIT and HAVING would apply to each part, not to the
+combined result, so queries with them (outside of parentheses) raise
+ValueError: sort, slice or filter the combined pyarrow.Table instead.
+
+The parts run in a multiprocessing pool (run_parts, iter_parts), each
+returning a pyarrow.Table, and are combined with pyarrow's group_by
+(combine_tables).
+"""
+
+import multiprocessing
+import os
+import re
+
+import pyarrow as pa
+
+from . import hll
+from .access import connect
+from .cache import arrow_rows
+
+
+KINDS = ('sum', 'min', 'max', 'hll')
+# Aggregate function of a result column name: how it combines
+FUNCTIONS = { 'count': 'sum', 'sum': 'sum', 'total': 'sum', 'min': 'min', 'max': 'max', 'hll_union': 'hll' }
+AGGREGATES = r'\b(count|sum|total|min|max|avg|group_concat|hll_union|hll_count)\s*\('
+
+
+def split_call(name):
+    """(function, [arguments]) if name is one function call f(...), and nothing else, or None
+
+    Arguments are split at the commas outside of parentheses and quotes.
+    """
+    m = re.match(r'\s*(\w+)\s*\(', name)
+    if not m:
+        return None
+    args, depth, quote, arg_start = [ ], 1, None, m.end()
+    for i in range(m.end(), len(name)):
+        c = name[i]
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '\'"`':
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                args.append(name[arg_start:i].strip())
+                # The closing parenthesis of the call must end the name
+                return (m[1].lower(), args) if not name[i+1:].strip() else None
+        elif c == ',' and depth == 1:
+            args.append(name[arg_start:i].strip())
+            arg_start = i + 1
+    return None
+
+
+def check_combinable(sql):
+    """Raise ValueError if sql has ORDER BY, LIMIT or HAVING outside of parentheses"""
+    outer, depth, quote = [ ], 0, None
+    for c in sql:
+        if quote:
+            if c == quote:
+                quote = None
+            c = ' '
+        elif c in '\'"`':
+            quote, c = c, ' '
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        outer.append(c if depth == 0 and c not in '()' else ' ')
+    m = re.search(r'\b(ORDER\s+BY|LIMIT|HAVING)\b', ''.join(outer), re.I)
+    if m:
+        raise ValueError(f"{m[1].upper()} would apply to each part of the data, not to the combined result: "
+                         f"leave it out and sort, slice or filter the combined table instead")
+
+
+def merge_kinds(names, merge=None):
+    """How each result column combines: a KINDS value, or None for group columns
+
+    Only a column that is one aggregate call, like 'sum(score)', is
+    known: expressions with aggregates in them, like
+    'sum(score)*1.0/count(*)', need merge.
+    """
+    merge = merge or { }
+    kinds = [ ]
+    for name in names:
+        if name in merge:
+            if merge[name] not in KINDS + (None, ):
+                raise ValueError(f"Unknown merge {merge[name]!r} of {name!r}, not one of {KINDS}")
+            kinds.append(merge[name])
+            continue
+        call = split_call(name)
+        # min() and max() of more than one argument are not aggregates
+        if call and call[0] in FUNCTIONS and not (call[0] in ('min', 'max') and len(call[1]) > 1) \
+                and not re.match(r'distinct\b', call[1][0], re.I):
+            kinds.append(FUNCTIONS[call[0]])
+        elif call and call[0] in ('avg', 'group_concat', 'hll_count') or (call and re.match(r'distinct\b', call[1][0], re.I)):
+            raise ValueError(f"{name} can't be combined from parts of the data: select sum() and count(), "
+                             f"or hll_union() sketches, instead (or give merge={{{name!r}: ...}})")
+        elif re.search(AGGREGATES, name, re.I):
+            raise ValueError(f"Don't know how to combine {name} from parts of the data: select the aggregates "
+                             f"in it as columns of their own and compute it from the combined result, or, if it "
+                             f"combines like one of {KINDS} (or is a group column, None), give merge={{{name!r}: ...}}")
+        else:
+            kinds.append(None)
+    return kinds
+
+
+def combine_values(kind, a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if kind == 'sum':
+        return a + b
+    if kind == 'min':
+        return min(a, b)
+    if kind == 'max':
+        return max(a, b)
+    if kind == 'hll':
+        sketch = hll.HLL.from_bytes(a)
+        sketch.update_bytes(b)
+        return sketch.to_bytes()
+    raise ValueError(kind)
+
+
+def combine(parts, kinds):
+    """One list of rows from the row lists parts, combined by kinds (see merge_kinds)
+
+    Groups are in the order they first appear in parts.
+    """
+    if all(kind is None for kind in kinds):
+        return [ row for rows in parts for row in rows ]
+    keys = [ i for i, kind in enumerate(kinds) if kind is None ]
+    aggregates = [ (i, kind) for i, kind in enumerate(kinds) if kind is not None ]
+    groups = { }
+    for rows in parts:
+        for row in rows:
+            key = tuple(row[i] for i in keys)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = list(row)
+                continue
+            for i, kind in aggregates:
+                group[i] = combine_values(kind, group[i], row[i])
+    return [ tuple(group) for group in groups.values() ]
+
+
+def combine_tables(tables, merge=None):
+    """One pyarrow.Table of the partial result tables, combined (merge: see merge_kinds)"""
+    names = tables[0].column_names
+    kinds = merge_kinds(names, merge)
+    try:
+        table = pa.concat_tables(tables, promote_options='default')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Parts where a column had mixed types, and became text
+        table = None
+    if table is not None and all(kind is None for kind in kinds):
+        return table
+    if table is None or 'hll' in kinds:
+        parts = [ list(zip(*(column.to_pylist() for column in t.columns))) for t in tables ]
+        return arrow_rows(names, combine(parts, kinds))
+    keys = [ name for name, kind in zip(names, kinds) if kind is None ]
+    aggregates = [ (name, kind) for name, kind in zip(names, kinds) if kind is not None ]
+    result = table.group_by(keys).aggregate(aggregates)
+    return result.select([ name if kind is None else f'{name}_{kind}' for name, kind in zip(names, kinds) ]) \
+                 .rename_columns(names)
+
+
+def default_processes():
+    if 'SLURM_CPUS_PER_TASK' in os.environ:
+        return int(os.environ['SLURM_CPUS_PER_TASK'])
+    return len(os.sched_getaffinity(0))
+
+
+def run_query(task):
+    """pyarrow.Table of the result of sql on the database path.  Runs in the worker processes"""
+    path, sql, params = task
+    cursor = connect(path).conn.execute(sql, params)
+    return arrow_rows([ x[0] for x in cursor.description ], cursor.fetchall())
+
+
+def iter_parts(tasks, processes=None, ordered=True):
+    """Yield run_query of each (path, sql, params) task, run in processes processes
+
+    ordered=False yields them as they finish: give the largest tasks
+    first, so that the last ones to finish are small.
+    """
+    processes = min(processes or default_processes(), len(tasks))
+    if processes <= 1:
+        for task in tasks:
+            yield run_query(task)
+        return
+    with multiprocessing.Pool(processes) as pool:
+        yield from (pool.imap if ordered else pool.imap_unordered)(run_query, tasks, chunksize=1)
+
+
+def run_parts(tasks, processes=None):
+    """List of run_query of each task, in order"""
+    return list(iter_parts(tasks, processes))
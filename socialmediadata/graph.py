@@ -0,0 +1,197 @@
+"""Reply graph of comments as compressed sparse row (CSR) arrays
+
+    g = smd.reply_graph('db.sqlite3', subreddits=['aaa'], start='2020-01-01')
+    g.children(g.index('t3_abc'))        # node numbers of the replies
+    g.created_utc[g.parents[i]]          # time of the parent of node i
+
+Nodes are all comments and submissions (within the filters), plus the
+parents they refer to that aren't in them, which have the attributes
+-1.  Node numbers are dense, in the order of the reddit ids.  An edge
+goes from each parent_id to the comment id (databases made with --thin
+have no parent_id, and link_id is used instead).  The graph is a few
+NumPy arrays of 4-8 bytes per node or edge:
+
+  keys         int64, the reddit id of each node (see id_key)
+  offsets      int64, children of node i are targets[offsets[i]:offsets[i+1]]
+  targets      int64, node numbers, in the order of their parent, then their own
+  parents      int64, the parent of each node, -1 for none
+  subreddit    int32, index into subreddit_names, -1 for unknown
+  author       int32, index into author_names, -1 for unknown
+  created_utc  int64, -1 for unknown
+
+They are saved as .npy files in DB.graph/KEY/ (KEY is made from the
+filters), with meta.json, and later loaded memory mapped instead of
+building again, as long as DB is the same file (see db_identity).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from .access import connect, db_identity, iter_rows, timestamp
+
+
+ARRAYS = ('keys', 'offsets', 'targets', 'parents', 'subreddit', 'author', 'created_utc',
+          'subreddit_names', 'author_names')
+PREFIXES = { 't3_': 0, 't1_': 1 }
+
+
+def id_key(id_):
+    """'t1_abc' -> int('abc', 36)*2 + 1, 't3_abc' -> int('abc', 36)*2, else -1"""
+    try:
+        return int(id_[3:], 36) * 2 + PREFIXES[id_[:3]]
+    except (TypeError, ValueError, KeyError):
+        return -1
+
+
+def key_id(key):
+    """Inverse of id_key"""
+    key = int(key)
+    value, prefix = divmod(key, 2)
+    s = ''
+    while True:
+        value, r = divmod(value, 36)
+        s = '0123456789abcdefghijklmnopqrstuvwxyz'[r] + s
+        if value == 0:
+            return ('t3_', 't1_')[prefix] + s
+
+
+class ReplyGraph:
+    """The arrays of a reply graph (see the module docstring) as attributes"""
+    def __init__(self, arrays, meta):
+        self.__dict__.update(arrays)
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return f'<ReplyGraph {len(self):,} nodes, {len(self.targets):,} edges>'
+
+    def index(self, id_):
+        """Node number of reddit id 't1_...' or 't3_...' (KeyError if not in the graph)"""
+        key = id_key(id_)
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            raise KeyError(id_)
+        return i
+
+    def id(self, i):
+        """Reddit id of node number i"""
+        return key_id(self.keys[i])
+
+    def children(self, i):
+        return self.targets[self.offsets[i]:self.offsets[i+1]]
+
+
+def load_graph(path, identity=None):
+    """The ReplyGraph saved in path, memory mapped, or None if it isn't there or is of another identity"""
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if identity is not None and any(meta.get(k) != v for k, v in identity.items()):
+        return None
+    return ReplyGraph({ name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ARRAYS }, meta)
+
+
+def names_array(names):
+    """dict name: number -> array of the names, fixed width so it can be memory mapped"""
+    return np.array(list(names), dtype=str) if names else np.zeros(0, dtype='U1')
+
+
+def build_graph(db, subreddits=None, start=None, end=None, batch_size=1000000):
+    """Read the comments and submissions of db and return the arrays of their graph"""
+    db = connect(db)
+    node_keys, parent_keys, subs, authors, times = [ ], [ ], [ ], [ ], [ ]
+    sub_numbers, author_numbers = { }, { }
+    for table in ('submissions', 'comments'):
+        if table not in db.columns:
+            continue
+        parent_col = None
+        if table == 'comments':
+            parent_col = 'parent_id' if 'parent_id' in db.columns[table] else 'link_id'
+        columns = [ 'id', 'subreddit', 'author', 'created_utc' ] + ([ parent_col ] if parent_col else [ ])
+        # The edges don't need the rows in time order: read in table order
+        for rows in iter_rows(db, table, subreddits, start, end, columns, batch_size=batch_size, format='rows',
+                              order=False):
+            n = len(rows)
+            node_keys.append(np.fromiter((id_key(row[0]) for row in rows), dtype=np.int64, count=n))
+            subs.append(np.fromiter((sub_numbers.setdefault(row[1], len(sub_numbers)) for row in rows),
+                                    dtype=np.int32, count=n))
+            authors.append(np.fromiter((author_numbers.setdefault(row[2], len(author_numbers)) for row in rows),
+                                       dtype=np.int32, count=n))
+            times.append(np.fromiter((-1 if row[3] is None else row[3] for row in rows), dtype=np.int64, count=n))
+            parent_keys.append(np.fromiter((id_key(row[4]) for row in rows), dtype=np.int64, count=n) if parent_col
+                               else np.full(n, -1, dtype=np.int64))
+    def concat(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+    node_keys, parent_keys = concat(node_keys, np.int64), concat(parent_keys, np.int64)
+    subs, authors, times = concat(subs, np.int32), concat(authors, np.int32), concat(times, np.int64)
+
+    # Dense node numbers: positions in the sorted unique keys
+    valid = node_keys >= 0
+    has_parent = valid & (parent_keys >= 0)
+    keys = np.unique(np.concatenate([ node_keys[valid], parent_keys[has_parent] ]))
+    n = len(keys)
+    nodes = np.searchsorted(keys, node_keys[valid])
+    attrs = { 'subreddit': subs, 'author': authors, 'created_utc': times }
+    for name, values in attrs.items():
+        array = np.full(n, -1, dtype=values.dtype)
+        array[nodes] = values[valid]
+        attrs[name] = array
+    del subs, authors, times
+
+    # Edges parent -> child, sorted by parent
+    children = np.searchsorted(keys, node_keys[has_parent])
+    parents_of = np.searchsorted(keys, parent_keys[has_parent])
+    del node_keys, parent_keys
+    parents = np.full(n, -1, dtype=np.int64)
+    parents[children] = parents_of
+    # Children of a parent by node number, whatever the order of the rows read
+    order = np.lexsort((children, parents_of))
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parents_of, minlength=n), out=offsets[1:])
+    return dict(keys=keys, offsets=offsets, targets=children[order], parents=parents, **attrs,
+                subreddit_names=names_array(sub_numbers), author_names=names_array(author_numbers))
+
+
+def reply_graph(db, subreddits=None, start=None, end=None, cache_dir=None, rebuild=False):
+    """The ReplyGraph of db, from DB.graph/ if it is there and db hasn't changed, else built and saved there
+
+    subreddits, start and end filter as in iter_comments.  cache_dir
+    (default DB.graph) must be writable to save a new build.
+    """
+    db = connect(db)
+    if isinstance(subreddits, str):
+        subreddits = [ subreddits ]
+    filters = { 'subreddits': subreddits, 'start': timestamp(start), 'end': timestamp(end) }
+    key = hashlib.sha1(json.dumps(filters, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir or f'{db.path}.graph', key)
+    identity = db_identity(db.path)
+    if not rebuild:
+        graph = load_graph(path, identity)
+        if graph is not None:
+            return graph
+
+    t = time.time()
+    arrays = build_graph(db, subreddits, start, end)
+    meta = dict(identity, filters=filters, nodes=len(arrays['keys']), edges=len(arrays['targets']),
+                build_s=time.time() - t, time=time.time())
+    # Written to a temporary directory, visible under its name only when complete
+    tmp = f'{path}.tmp-{os.getpid()}'
+    os.makedirs(tmp, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, f'{name}.npy'), array)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    print(f"Reply graph: {meta['nodes']:,} nodes, {meta['edges']:,} edges in {meta['build_s']:.1f} s, saved to {path}")
+    return load_graph(path)
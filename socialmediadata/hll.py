@@ -0,0 +1,158 @@
+"""HyperLogLog sketches: approximate distinct counts that can be merged
+
+A sketch of 2**P one-byte registers estimates the number of distinct
+values added to it within about 1.04/sqrt(2**P) (1.6% for P=12).  The
+union of two sketches is their element-wise maximum, so the sketches of
+days can be merged into those of years, or of subreddits.  Values are
+hashed with 64-bit blake2b, so sketches made by different processes and
+runs are compatible.
+
+BLOBs: sketches of few values (SPARSE_MAX registers or fewer set) are
+b'S' and uint32 (register << 6 | value) of the set registers, so a
+day of a small subreddit takes a few bytes.  Others are b'D' and the
+zlib-compressed registers.
+
+    conn = sqlite3.connect(...)
+    hll.register_sqlite(conn)
+    conn.execute('SELECT subreddit, hll_count(hll_union(authors)) FROM comments_daily GROUP BY subreddit')
+"""
+
+import hashlib
+import math
+import zlib
+
+import numpy as np
+
+
+P = 12
+M = 1 << P
+ALPHA = 0.7213 / (1 + 1.079 / M)
+SPARSE_MAX = 256
+SPARSE, DENSE = b'S', b'D'
+
+
+def hash64(values, memo=None):
+    """uint64 array of the hashes of str values (None hashes as '').
+
+    memo, a dict, caches the hashes of values seen before.
+    """
+    if memo is None:
+        memo = { }
+    def h(value):
+        try:
+            return memo[value]
+        except KeyError:
+            x = memo[value] = int.from_bytes(hashlib.blake2b(str(value or '').encode(), digest_size=8).digest(), 'little')
+            return x
+    return np.fromiter((h(v) for v in values), dtype=np.uint64, count=len(values))
+
+
+def bit_length(x):
+    """Element-wise int.bit_length of a uint64 array"""
+    hi = (x >> np.uint64(32)).astype(np.float64)
+    lo = (x & np.uint64(0xffffffff)).astype(np.float64)
+    # frexp's exponent is the bit length, exact for 32-bit values
+    return np.where(hi > 0, 32 + np.frexp(hi)[1], np.frexp(lo)[1])
+
+
+def registers_of(hashes):
+    """Register numbers and values of hashes: first P bits, and 1 + leading zeros of the rest"""
+    index = (hashes >> np.uint64(64 - P)).astype(np.intp)
+    rest = hashes & np.uint64((1 << (64 - P)) - 1)
+    return index, (64 - P + 1 - bit_length(rest)).astype(np.uint8)
+
+
+class HLL:
+    def __init__(self, registers=None):
+        self.registers = np.zeros(M, dtype=np.uint8) if registers is None else registers
+
+    def add_hashes(self, hashes):
+        index, rank = registers_of(hashes)
+        np.maximum.at(self.registers, index, rank)
+
+    def add(self, values, memo=None):
+        self.add_hashes(hash64(values, memo))
+
+    def update(self, other):
+        """Union with another HLL"""
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        """Estimated number of distinct values added"""
+        registers = self.registers
+        estimate = ALPHA * M * M / np.sum(np.ldexp(1.0, -registers.astype(np.int32)))
+        zeros = M - np.count_nonzero(registers)
+        # Small counts: linear counting of the empty registers is better
+        if estimate <= 2.5 * M and zeros:
+            estimate = M * math.log(M / zeros)
+        return int(round(estimate))
+
+    def update_bytes(self, data):
+        """Union with a sketch BLOB"""
+        if data[:1] == SPARSE:
+            entries = np.frombuffer(data, dtype='<u4', offset=1)
+            index = entries >> 6
+            self.registers[index] = np.maximum(self.registers[index], entries & 63)
+        else:
+            np.maximum(self.registers, np.frombuffer(zlib.decompress(data[1:]), dtype=np.uint8), out=self.registers)
+
+    def to_bytes(self):
+        index = np.flatnonzero(self.registers)
+        if len(index) <= SPARSE_MAX:
+            return SPARSE + ((index << 6) | self.registers[index]).astype('<u4').tobytes()
+        return DENSE + zlib.compress(self.registers.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        hll = cls()
+        hll.update_bytes(data)
+        return hll
+
+
+def group_sketches(groups, hashes, n_groups):
+    """Sketch BLOBs of the hashes of each group, for group numbers 0 ... n_groups-1
+
+    All groups at once: a sparse sketch is a slice of the sorted unique
+    (group, register, value) of all hashes.
+    """
+    index, rank = registers_of(hashes)
+    entries = np.unique((groups.astype(np.uint64) << np.uint64(18))
+                        | (index.astype(np.uint64) << np.uint64(6)) | rank.astype(np.uint64))
+    # The largest value of each register is the last of its entries
+    entries = entries[np.append((entries[1:] >> np.uint64(6)) != (entries[:-1] >> np.uint64(6)), True)]
+    bounds = np.searchsorted((entries >> np.uint64(18)).astype(np.int64), np.arange(n_groups + 1))
+    entries = (entries & np.uint64(0x3ffff)).astype('<u4')
+    sketches = [ ]
+    for i, j in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        if j - i <= SPARSE_MAX:
+            sketches.append(SPARSE + entries[i:j].tobytes())
+        else:
+            hll = HLL()
+            hll.update_bytes(SPARSE + entries[i:j].tobytes())
+            sketches.append(hll.to_bytes())
+    return sketches
+
+
+def count(data):
+    """Estimated distinct count of a sketch BLOB (None: None)"""
+    return None if data is None else HLL.from_bytes(data).count()
+
+
+class Union:
+    """sqlite3 aggregate: the union of sketch BLOBs"""
+    def __init__(self):
+        self.hll = None
+    def step(self, data):
+        if data is None:
+            return
+        if self.hll is None:
+            self.hll = HLL()
+        self.hll.update_bytes(data)
+    def finalize(self):
+        return None if self.hll is None else self.hll.to_bytes()
+
+
+def register_sqlite(conn):
+    """Add the SQL functions hll_union(sketch) (aggregate) and hll_count(sketch) to conn"""
+    conn.create_aggregate('hll_union', 1, Union)
+    conn.create_function('hll_count', 1, count, deterministic=True)
@@ -0,0 +1,237 @@
+"""Run one query on slices of a database in parallel processes
+
+    import socialmediadata as smd
+    smd.query_parallel('db.sqlite3',
+                       "SELECT author, count(*), sum(score) FROM comments WHERE subreddit = :subreddit "
+                       "AND created_utc >= :start AND created_utc < :end GROUP BY author",
+                       subreddits=['politics'])
+
+SQLite runs a query on one core, but the databases are opened
+immutable, so any number of processes can read one at the same time.
+The query is run once per slice: per subreddit (if it has :subreddit),
+disjoint created_utc ranges [:start, :end) covering start to end (or
+all times of the subreddit).  With the same conditions as iter_rows,
+each slice is a range of the (subreddit, created_utc) or created_utc
+index.  The slices have about the same number of rows, according to
+the TABLE_daily rollups (--rollups) if the database has them, else to
+the created_utc of a sample of rows spread over the table (read by
+rowid, so the same cost for any size of table).  Subreddits with too
+few rows in the sample are counted in the index instead.  There are
+more slices than processes, to even out the differences, and the
+largest slices run first.
+The results are combined as described in combine.  Rows without
+created_utc are not in any slice.
+"""
+
+from datetime import datetime, timezone
+import json
+import re
+
+from .access import connect, timestamp
+from .combine import check_combinable, combine_tables, default_processes, iter_parts
+
+
+SLICES_PER_PROCESS = 4
+MIN_SLICE_ROWS = 50000
+# Fewest rows between the index lookups of make_slices
+MIN_STEP_ROWS = 1000
+# Rows sampled to plan the slices without rollups, and the fewest of a
+# group to use the sample instead of counting its rows in the index
+SAMPLE_ROWS = 10000
+MIN_SAMPLES = 100
+
+
+def table_of(sql):
+    """The table (comments or submissions) sql reads, by its first FROM"""
+    m = re.search(r'\bFROM\s+(comments|submissions)', sql, re.I)
+    return m[1].lower() if m else 'comments'
+
+
+def subreddit_condition(subreddits):
+    if subreddits is None:
+        return '1', [ ]
+    return f'subreddit IN ({", ".join("?" * len(subreddits))})', list(subreddits)
+
+
+def time_bounds(db, table, subreddits, start, end):
+    """(start, end) of the slices of subreddits: the given times, else the first and last+1 times there"""
+    where, params = subreddit_condition(subreddits)
+    if start is None:
+        # Separate min and max, so that each is one index lookup
+        start = db.conn.execute(f'SELECT min(created_utc) FROM {table} WHERE {where}', params).fetchone()[0]
+    if end is None:
+        end = db.conn.execute(f'SELECT max(created_utc) FROM {table} WHERE {where}', params).fetchone()[0]
+        end = None if end is None else end + 1
+    return start, end
+
+
+def month_start(month):
+    return int(datetime.strptime(month, '%Y-%m').replace(tzinfo=timezone.utc).timestamp())
+
+
+def rollup_rows(db, table, subreddits, start, end):
+    """[ (time, rows) ] of subreddits from start to end: per day (per month for all subreddits), or None without rollups"""
+    names = { x[0] for x in db.conn.execute("SELECT name FROM sqlite_master WHERE type='table'") }
+    where, params = subreddit_condition(subreddits)
+    if subreddits is not None and f'{table}_daily' in names:
+        rows = db.conn.execute(f'SELECT day * 86400, sum(n) FROM {table}_daily WHERE {where} '
+                               f'AND day >= ? AND day <= ? GROUP BY day ORDER BY day',
+                               params + [ start // 86400, end // 86400 ]).fetchall()
+    elif f'{table}_monthly' in names:
+        rows = [ (month_start(month), n) for month, n in
+                 db.conn.execute(f'SELECT month, sum(n) FROM {table}_monthly WHERE {where} '
+                                 f'GROUP BY month ORDER BY month', params) ]
+        rows = [ (t, n) for t, n in rows if start - 31 * 86400 < t < end ]
+    else:
+        return None
+    return [ (t, n) for t, n in rows if n ]
+
+
+def sample_rows(db, table):
+    """([ (subreddit, created_utc) ] of SAMPLE_ROWS rows spread over table, rows per sampled row), or None
+
+    The rows are looked up by rowid.  None for tables without rowids
+    (--cluster).
+    """
+    tables = dict(db.conn.execute("SELECT name, sql FROM sqlite_master WHERE type='table'"))
+    data = f'{table}_data' if f'{table}_data' in tables else table
+    if data not in tables or 'WITHOUT ROWID' in tables[data]:
+        return None
+    last = db.conn.execute(f'SELECT max(rowid) FROM {data}').fetchone()[0]
+    if not last:
+        return [ ], 0
+    n = min(SAMPLE_ROWS, last)
+    # Normalized: the name of the subreddit_id
+    subreddit = 'subreddit' if data == table else '(SELECT name FROM subreddits WHERE id = subreddit_id)'
+    rows = db.conn.execute(f'SELECT {subreddit}, created_utc FROM {data} WHERE rowid IN (SELECT value FROM json_each(?))',
+                           (json.dumps([ 1 + i * last // n for i in range(n) ]), )).fetchall()
+    return rows, last / n
+
+
+def index_count(db, table, subreddits, start, end):
+    """Rows of subreddits with start <= created_utc < end"""
+    where, params = subreddit_condition(subreddits)
+    return db.conn.execute(f'SELECT count(*) FROM {table} WHERE {where} AND created_utc >= ? AND created_utc < ?',
+                           params + [ start, end ]).fetchone()[0]
+
+
+def index_rows(db, table, subreddits, start, end, step):
+    """[ (time, rows) ] of subreddits from start to end, in parts of step rows, from the created_utc index
+
+    Each part starts at the time of the row step rows after the start of
+    the previous part, found with LIMIT 1 OFFSET step.  Subreddits are
+    walked one at a time, so that each walk is one index range.
+    """
+    rows = [ ]
+    for sub in (subreddits if subreddits is not None else [ None ]):
+        where, params = subreddit_condition(None if sub is None else [ sub ])
+        sql = (f'SELECT created_utc FROM {table} WHERE {where} AND created_utc >= ? AND created_utc < ? '
+               f'ORDER BY created_utc LIMIT 1 OFFSET ?')
+        t = start
+        while True:
+            row = db.conn.execute(sql, params + [ t, end, step ]).fetchone()
+            if row is None:
+                rows.append((t, index_count(db, table, None if sub is None else [ sub ], t, end)))
+                break
+            # Many rows of the same time: the next part starts after them
+            t_next = max(row[0], t + 1)
+            rows.append((t, step))
+            t = t_next
+    rows.sort()
+    return [ (t, n) for t, n in rows if n ]
+
+
+def cut(start, end, rows, target):
+    """Times from start to end, dividing rows ([ (time, n) ]) into parts of about target rows, and the rows of each part"""
+    times, sizes, size = [ start ], [ ], 0
+    for t, n in rows:
+        if size >= target and times[-1] < t < end:
+            times.append(t)
+            sizes.append(size)
+            size = 0
+        size += n
+    times.append(end)
+    sizes.append(size)
+    return times, sizes
+
+
+def make_slices(db, sql, subreddits=None, start=None, end=None, n_slices=None, table=None):
+    """[ (params, estimated rows) ] of the slices of sql, largest first.  params are subreddit, start and end"""
+    db = connect(db)
+    table = table or table_of(sql)
+    if isinstance(subreddits, str):
+        subreddits = [ subreddits ]
+    if ':subreddit' in sql:
+        if subreddits is None:
+            raise ValueError("sql has :subreddit, give the subreddits")
+        groups = [ [ sub ] for sub in subreddits ]
+    else:
+        groups = [ subreddits ]
+    n_slices = n_slices or SLICES_PER_PROCESS * default_processes()
+    start, end = timestamp(start), timestamp(end)
+
+    bounds = [ time_bounds(db, table, group, start, end) for group in groups ]
+    rollups = [ rollup_rows(db, table, group, *bound) if bound[0] is not None and bound[1] is not None else [ ]
+                for group, bound in zip(groups, bounds) ]
+    sample = sample_rows(db, table) if any(rows is None for rows in rollups) else None
+    estimates = [ ]
+    for i, (group, (lo, hi), rows) in enumerate(zip(groups, bounds, rollups)):
+        if lo is None or hi is None or lo >= hi:
+            rollups[i] = [ ]
+        elif rows is None and sample is not None:
+            subs = None if group is None else set(group)
+            times = sorted(t for sub, t in sample[0] if (subs is None or sub in subs) and t is not None and lo <= t < hi)
+            if len(times) >= MIN_SAMPLES:
+                rollups[i] = [ (t, sample[1]) for t in times ]
+        if rollups[i] is None:
+            # Too few rows to sample: counted in the index
+            estimates.append(index_count(db, table, group, lo, hi))
+        else:
+            estimates.append(sum(n for _, n in rollups[i]))
+    estimate = sum(estimates)
+    n_slices = max(1, min(n_slices, int(estimate // MIN_SLICE_ROWS)))
+    target = max(estimate / n_slices, 1)
+
+    slices = [ ]
+    for group, (lo, hi), rows in zip(groups, bounds, rollups):
+        if lo is None or hi is None or lo >= hi:
+            continue
+        if rows is None:
+            # Parts of a quarter slice (over all subreddits of the group, which are
+            # walked separately), so that the cuts are close to the target
+            step = int(target) // (4 * (len(group) if group else 1))
+            rows = index_rows(db, table, group, lo, hi, max(step, MIN_STEP_ROWS))
+        times, sizes = cut(lo, hi, rows, target)
+        for a, b, size in zip(times[:-1], times[1:], sizes):
+            slices.append(({ 'subreddit': group[0] if group and ':subreddit' in sql else None,
+                             'start': a, 'end': b }, size))
+    slices.sort(key=lambda x: -x[1])
+    return slices
+
+
+def iter_parallel(db, sql, params=None, subreddits=None, start=None, end=None, processes=None, table=None):
+    """Yield the pyarrow.Table result of each slice of sql, as they finish (see the module docstring)
+
+    sql must select the slice with created_utc >= :start AND
+    created_utc < :end, and with subreddit = :subreddit to be sliced by
+    subreddit too.  params are more named parameters.  table (comments
+    or submissions) is the table to slice, by default the first in sql.
+    """
+    if ':start' not in sql or ':end' not in sql:
+        raise ValueError("sql must select the slice with created_utc >= :start AND created_utc < :end")
+    db = connect(db)
+    if isinstance(subreddits, str):
+        subreddits = [ subreddits ]
+    processes = processes or default_processes()
+    slices = make_slices(db, sql, subreddits, start, end, SLICES_PER_PROCESS * processes, table)
+    if not slices:
+        # No rows: the result of an empty range, for its columns
+        slices = [ ({ 'subreddit': subreddits[0] if subreddits else None, 'start': 0, 'end': 0 }, 0) ]
+    tasks = [ (db.path, sql, dict(params or { }, **slice_params)) for slice_params, _ in slices ]
+    yield from iter_parts(tasks, processes, ordered=False)
+
+
+def query_parallel(db, sql, params=None, subreddits=None, start=None, end=None, merge=None, processes=None, table=None):
+    """pyarrow.Table of sql run on slices of db in parallel, combined (merge: see combine.merge_kinds)"""
+    check_combinable(sql)
+    return combine_tables(list(iter_parallel(db, sql, params, subreddits, start, end, processes, table)), merge)
@@ -0,0 +1,68 @@
+"""Queries over the year databases of load-queue.py --split-years
+
+    import socialmediadata as smd
+    smd.query_years('db.sqlite3.manifest.json',
+                    "SELECT subreddit, count(*), sum(score) FROM comments "
+                    "WHERE created_utc >= :start AND created_utc < :end GROUP BY subreddit",
+                    start='2015-06-01', end='2017-01-01')
+
+Only the databases of the years overlapping [start, end) are queried,
+each in its own process, with the parameters start and end (as Unix
+times) added to params: the times of its year, within start and end
+if they are given.  The partial results are combined as described
+in combine: counts and sums added, minimums and maximums, HLL sketches
+united, by the other columns.  The database of rows without a time is
+only queried when there is neither start nor end.
+"""
+
+import json
+import os
+
+from .access import timestamp
+from .combine import check_combinable, combine_tables, run_parts
+
+
+def load_manifest(path):
+    """The manifest written by --split-years, with the paths of the databases made absolute"""
+    with open(path) as f:
+        manifest = json.load(f)
+    for shard in manifest['shards']:
+        shard['path'] = os.path.join(os.path.dirname(os.path.abspath(path)), shard['path'])
+    return manifest
+
+
+def select_shards(manifest, start=None, end=None):
+    """The shards of manifest (a path or loaded) with times overlapping [start, end)"""
+    if isinstance(manifest, str):
+        manifest = load_manifest(manifest)
+    start, end = timestamp(start), timestamp(end)
+    selected = [ ]
+    for shard in manifest['shards']:
+        if shard['start'] is None:
+            if start is None and end is None:
+                selected.append(shard)
+            continue
+        if (start is None or shard['end'] > start) and (end is None or shard['start'] < end):
+            selected.append(shard)
+    return selected
+
+
+def query_years(manifest, sql, params=None, start=None, end=None, merge=None, processes=None):
+    """pyarrow.Table of sql run on the year databases of manifest between start and end, combined
+
+    params is a dict of named parameters, to which start and end are
+    added (per database, see the module docstring).  merge gives how the columns renamed with AS combine (see
+    combine.merge_kinds).  processes defaults to the CPUs of the job.
+    """
+    check_combinable(sql)
+    shards = select_shards(manifest, start, end)
+    if not shards:
+        raise ValueError(f"No databases between {start} and {end} in {manifest}")
+    start, end = timestamp(start), timestamp(end)
+    tasks = [ ]
+    for shard in shards:
+        # Open ends are the bounds of the year (None for rows without a time)
+        shard_start = shard['start'] if start is None or shard['start'] is None else max(start, shard['start'])
+        shard_end = shard['end'] if end is None or shard['end'] is None else min(end, shard['end'])
+        tasks.append((shard['path'], sql, dict(params or { }, start=shard_start, end=shard_end)))
+    return combine_tables(run_parts(tasks, processes), merge)
@@ -0,0 +1,142 @@
+"""Combining the results of query_years and query_parallel
+
+Run with: python -m pytest tests
+"""
+
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import socialmediadata as smd
+from socialmediadata import parallel
+from socialmediadata.combine import merge_kinds
+
+
+LOAD_QUEUE = os.path.join(os.path.dirname(__file__), '..', 'load-queue.py')
+SUBREDDITS = [ 'aaa', 'bbbbb', 'cc' ]
+START = int(datetime(2015, 3, 1, tzinfo=timezone.utc).timestamp())
+END = int(datetime(2018, 3, 1, tzinfo=timezone.utc).timestamp())
+
+COMPOUND = [
+    'sum(score)*1.0/count(*)',
+    'max(created_utc)-min(created_utc)',
+    'coalesce(count(*),0)',
+    ]
+
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory):
+    """An indexed database of comments from 2015 to 2018, and its --split-years year databases"""
+    tmp = tmp_path_factory.mktemp('db')
+    path = str(tmp / 'db.sqlite3')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE comments (subreddit TEXT, author TEXT, id TEXT, link_id TEXT, created_utc INTEGER, '
+                 'score INTEGER, parent_id TEXT, body TEXT)')
+    rng = random.Random(1)
+    rows = [ ]
+    for i in range(20000):
+        # Most rows at the end, so that equal time ranges have unequal rows
+        t = START + int((END - START) * rng.random() ** 0.3)
+        rows.append((rng.choice(SUBREDDITS), f'u{rng.randrange(300)}', f'c{i}', 't3_x', t,
+                     rng.randrange(-5, 50), 't3_x', 'text'))
+    conn.executemany('INSERT INTO comments VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+    for flags in ([ '--index' ], [ '--split-years' ]):
+        subprocess.run([ sys.executable, LOAD_QUEUE, *flags, path, '-' ], cwd=tmp, check=True,
+                       stdout=subprocess.DEVNULL)
+    return path
+
+
+def expected(db, sql, params=()):
+    return sorted(sqlite3.connect(db).execute(sql, params).fetchall(), key=repr)
+
+
+def rows(table):
+    return sorted((tuple(row.values()) for row in table.to_pylist()), key=repr)
+
+
+def test_merge_kinds():
+    assert merge_kinds([ 'subreddit', 'count(*)', 'sum(score)', 'min(created_utc)', 'max(x)', 'hll_union(a)' ]) == \
+        [ None, 'sum', 'sum', 'min', 'max', 'hll' ]
+    assert merge_kinds([ "strftime('%Y', created_utc, 'unixepoch')", 'n' ]) == [ None, None ]
+    assert merge_kinds([ 'n' ], merge={ 'n': 'sum' }) == [ 'sum' ]
+    for name in COMPOUND + [ 'avg(score)', 'count(DISTINCT author)' ]:
+        with pytest.raises(ValueError):
+            merge_kinds([ 'subreddit', name ])
+
+
+def test_query_years(db):
+    sql = ('SELECT subreddit, count(*), sum(score), min(created_utc), max(created_utc) FROM comments '
+           'WHERE created_utc >= :start AND created_utc < :end GROUP BY subreddit')
+    start, end = START + 100 * 86400, END - 100 * 86400
+    table = smd.query_years(db + '.manifest.json', sql, start=start, end=end, processes=2)
+    assert rows(table) == expected(db, sql, { 'start': start, 'end': end })
+
+
+@pytest.mark.parametrize('start, end', [ (None, None), (START + 400 * 86400, None), (None, END - 400 * 86400) ])
+def test_query_years_open(db, start, end):
+    """Without start or end, all the times in that direction"""
+    sql = ('SELECT subreddit, count(*), min(created_utc), max(created_utc) FROM comments '
+           'WHERE created_utc >= :start AND created_utc < :end GROUP BY subreddit')
+    table = smd.query_years(db + '.manifest.json', sql, start=start, end=end, processes=2)
+    assert rows(table) == expected(db, sql, { 'start': start or 0, 'end': end or 10**10 })
+
+
+def test_query_parallel(db, monkeypatch):
+    monkeypatch.setattr(parallel, 'MIN_SLICE_ROWS', 1000)
+    sql = ('SELECT author, count(*), sum(score), max(created_utc) FROM comments WHERE subreddit = :subreddit '
+           'AND created_utc >= :start AND created_utc < :end GROUP BY author')
+    table = smd.query_parallel(db, sql, subreddits=SUBREDDITS, processes=2)
+    assert rows(table) == expected(db, 'SELECT author, count(*), sum(score), max(created_utc) FROM comments '
+                                       'GROUP BY author')
+
+
+def test_compound(db, monkeypatch):
+    monkeypatch.setattr(parallel, 'MIN_SLICE_ROWS', 1000)
+    for name in COMPOUND:
+        sql = f'SELECT subreddit, {name} FROM comments WHERE created_utc >= :start AND created_utc < :end GROUP BY subreddit'
+        with pytest.raises(ValueError, match='merge='):
+            smd.query_years(db + '.manifest.json', sql, start=START, end=END, processes=2)
+        with pytest.raises(ValueError, match='merge='):
+            smd.query_parallel(db, sql, processes=2)
+
+
+@pytest.mark.parametrize('min_samples', [ 100, 10**9 ])
+def test_slices(db, monkeypatch, min_samples):
+    """Slices have about the same number of rows, though the rows are not even in time
+
+    Planned from the sample of rows, or, with too few in the sample,
+    from the index.
+    """
+    monkeypatch.setattr(parallel, 'MIN_SLICE_ROWS', 1000)
+    monkeypatch.setattr(parallel, 'MIN_STEP_ROWS', 100)
+    monkeypatch.setattr(parallel, 'MIN_SAMPLES', min_samples)
+    sql = 'SELECT count(*) FROM comments WHERE created_utc >= :start AND created_utc < :end'
+    slices = parallel.make_slices(db, sql, n_slices=8)
+    sizes = [ expected(db, sql, params)[0][0] for params, _ in slices ]
+    assert sum(sizes) == 20000
+    assert len(slices) == 8
+    assert max(sizes[:-1]) < 1.2 * 20000 / 8
+    assert [ size for _, size in slices ] == sorted((size for _, size in slices), reverse=True)
+
+
+def test_per_part_clauses(db):
+    for clause in ('ORDER BY 2 DESC', 'LIMIT 2', 'HAVING count(*) > 10'):
+        sql = f'SELECT subreddit, count(*) FROM comments WHERE created_utc >= :start AND created_utc < :end GROUP BY subreddit {clause}'
+        with pytest.raises(ValueError, match='combined'):
+            smd.query_years(db + '.manifest.json', sql, start=START, end=END)
+        with pytest.raises(ValueError, match='combined'):
+            smd.query_parallel(db, sql)
+    # In a subquery they are run as usual
+    sql = ('SELECT count(*) FROM comments WHERE created_utc >= :start AND created_utc < :end AND author IN '
+           '(SELECT author FROM comments GROUP BY author ORDER BY count(*) DESC LIMIT 10)')
+    assert rows(smd.query_parallel(db, sql, processes=2)) == \
+        expected(db, sql.replace(':start', '0').replace(':end', str(END)))
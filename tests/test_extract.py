@@ -0,0 +1,52 @@
+"""The JSON engines of extract.py give the same rows
+
+Run with: python -m pytest tests
+"""
+
+import os
+import pickle
+import sys
+
+import orjson
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import extract
+
+
+COLUMNS = [
+    ('id', 'TEXT', lambda x: 't1_' + x['id']),
+    ('author', 'TEXT'),
+    ('score', 'INTEGER'),
+    ('gildings', 'TEXT'),
+    ('all_awardings', 'TEXT'),
+    ('edited', 'INTEGER'),
+    ]
+
+LINES = [
+    { 'id': 'abc', 'author': 'a', 'score': 3, 'gildings': { 'gid_1': 1, 'nested': { 'x': [ 1, 2 ] } },
+      'all_awardings': [ { 'name': 'Silver', 'count': 1 }, [ 1, 'two' ] ], 'edited': False },
+    { 'id': 'abd', 'author': None, 'score': -1, 'gildings': { }, 'all_awardings': [ ], 'edited': 1600000000 },
+    { 'id': 'abe', 'score': 0, 'body': 'no author, gildings or all_awardings' },
+    ]
+
+
+@pytest.mark.skipif(extract.simdjson is None, reason="needs pysimdjson")
+def test_engines():
+    decoders = [ extract.make_decoder(COLUMNS, engine) for engine in ('orjson', 'simdjson') ]
+    for obj in LINES:
+        line = orjson.dumps(obj)
+        rows = [ decode(line) for decode in decoders ]
+        assert rows[0] == rows[1]
+        # Rows go to the inserter through a multiprocessing queue
+        assert pickle.loads(pickle.dumps(rows[1])) == rows[0]
+        assert all(type(a) is type(b) for a, b in zip(*rows))
+
+
+def test_bad_line():
+    decode = extract.make_decoder(COLUMNS, 'orjson')
+    with pytest.raises(extract.BAD_LINE):
+        decode(b'{"author": "no id"}')
+    with pytest.raises(extract.BAD_LINE):
+        decode(b'not json')
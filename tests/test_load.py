@@ -0,0 +1,148 @@
+"""load-queue.py end to end, on synthetic dumps from bench/make_data.py
+
+Each load runs load-queue.py in a subprocess, in a temporary directory
+(it writes load-queue.log there), and is compared with one plain load
+of the same files.
+
+Run with: python -m pytest tests
+"""
+
+import glob
+import os
+import re
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LOAD_QUEUE = os.path.join(ROOT, 'load-queue.py')
+
+
+def load(cwd, db, files, *args):
+    """Run load-queue.py --comments DB FILES ARGS, return its output"""
+    files = [ files ] if isinstance(files, str) else files
+    return subprocess.run([ sys.executable, LOAD_QUEUE, '--comments', '--readers=1', '--decoders=1', *args, db, *files ],
+                          cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+def table_rows(db, table='comments'):
+    conn = sqlite3.connect(db)
+    rows = conn.execute(f'SELECT * FROM {table} ORDER BY id').fetchall()
+    conn.close()
+    return rows
+
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    """Comment dumps of a few subreddits in frames of 0.5 MB, with sidecar indexes, and a plain load of them"""
+    tmp = tmp_path_factory.mktemp('data')
+    subprocess.run([ sys.executable, os.path.join(ROOT, 'bench', 'make_data.py'), str(tmp / 'dumps'),
+                     '--comments=30000', '--subs=5', '--bad=0', '--frame-mb=0.5' ], check=True, capture_output=True)
+    files = sorted(glob.glob(str(tmp / 'dumps' / '*_comments.zst')))
+    subprocess.run([ sys.executable, os.path.join(ROOT, 'zst.py'), 'index', *files ], check=True, capture_output=True)
+    reference = str(tmp / 'reference.db')
+    load(tmp, reference, files)
+    return files, reference, table_rows(reference)
+
+
+def test_reference(data):
+    files, _, reference = data
+    ids = [ row[2] for row in reference ]
+    assert len(ids) == len(set(ids)) > 20000
+
+
+def test_split_bytes(data, tmp_path):
+    """Frame ranges of one file, read by several readers, give the same rows"""
+    files, _, reference = data
+    out = load(tmp_path, str(tmp_path / 'db'), files, '--split-bytes=300000', '--readers=3')
+    assert re.search(r'sub0000\[\d+:\d+\]', out)    # status lines of frame ranges: SUB[start:stop]
+    assert table_rows(tmp_path / 'db') == reference
+
+
+def test_shared_memory(data, tmp_path):
+    """Chunks through shared memory slots give the same rows"""
+    files, _, reference = data
+    load(tmp_path, str(tmp_path / 'db'), files, '--shm-mb=1', '--decoders=2')
+    assert table_rows(tmp_path / 'db') == reference
+
+
+def test_shards_merge(data, tmp_path):
+    """--shard K/N loads of parts of the files, merged with --merge, give the rows of one load"""
+    files, _, reference = data
+    db = str(tmp_path / 'db')
+    for k in range(3):
+        load(tmp_path, db, files, f'--shard={k}/3')
+    shards = sorted(glob.glob(f'{db}.shard[0-9]'))
+    assert len(shards) == 3 and all(len(table_rows(shard)) < len(reference) for shard in shards)
+    load(tmp_path, db, shards, '--merge')
+    assert table_rows(db) == reference
+    indexes = { x[0] for x in sqlite3.connect(db).execute("SELECT name FROM sqlite_master WHERE type='index'") }
+    assert 'idx_com_sub_cre' in indexes
+
+
+def test_cluster(data, tmp_path):
+    """--index --cluster makes the table WITHOUT ROWID with the (subreddit, created_utc, id) key, same rows"""
+    _, reference_db, reference = data
+    db = str(tmp_path / 'db')
+    shutil.copy(reference_db, db)
+    load(tmp_path, db, '-', '--index', '--cluster')
+    conn = sqlite3.connect(db)
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'comments'").fetchone()[0]
+    assert 'WITHOUT ROWID' in sql
+    key = [ x[1] for x in sorted((x for x in conn.execute('PRAGMA table_info(comments)') if x[5]), key=lambda x: x[5]) ]
+    assert key == [ 'subreddit', 'created_utc', 'id' ]
+    # The table is the (subreddit, created_utc) index: no separate one
+    plan = ' '.join(x[3] for x in conn.execute("EXPLAIN QUERY PLAN SELECT * FROM comments "
+                                               "WHERE subreddit = 'sub0001' AND created_utc >= 0"))
+    assert 'PRIMARY KEY' in plan
+    conn.close()
+    assert table_rows(db) == reference
+    # Appends to it skip the rows that are already there (a new file, not skipped as loaded)
+    os.mkdir(tmp_path / 'new')
+    out = load(tmp_path, db, str(shutil.copy(data[0][0], tmp_path / 'new')), '--append')
+    assert table_rows(db) == reference
+    assert re.search(r'Rows skipped as already present: [1-9]', out)
+
+
+@pytest.mark.parametrize('args', [ [ ], [ '--split-bytes=300000', '--readers=2' ] ])
+def test_resume(data, tmp_path, args):
+    """A load killed after some commits, run again, has every row once"""
+    files, _, reference = data
+    db = str(tmp_path / 'db')
+    # Small chunks, each committed: the kill comes in the middle of a file
+    args = [ '--chunk-lines=500', '--insert-batch=1', *args ]
+    p = subprocess.Popen([ sys.executable, LOAD_QUEUE, '--comments', '--readers=1', '--decoders=1', *args, db, *files ],
+                         cwd=tmp_path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                         env=dict(os.environ, PYTHONUNBUFFERED='1'), start_new_session=True)
+    for line in p.stdout:
+        if line.startswith('Committed batch 10'):
+            # All processes of the load, as a job scheduler would
+            os.killpg(p.pid, signal.SIGKILL)
+            break
+    p.wait()
+    p.stdout.close()
+    assert p.returncode == -signal.SIGKILL
+    assert 0 < len(table_rows(db)) < len(reference)
+    load(tmp_path, db, files, *args)
+    assert table_rows(db) == reference
+
+
+def test_append(data, tmp_path):
+    """--append of a refreshed dump (new files with old and new rows) adds only the rows whose id is new"""
+    files, _, reference = data
+    db = str(tmp_path / 'db')
+    load(tmp_path, db, files[:2])
+    n_old = len(table_rows(db))
+    for i in range(2):
+        # New paths each time, so that loaded_files doesn't skip the files
+        os.mkdir(tmp_path / f'refresh{i}')
+        refreshed = [ str(shutil.copy(f, tmp_path / f'refresh{i}')) for f in files ]
+        out = load(tmp_path, db, refreshed, '--append')
+        assert table_rows(db) == reference
+        # The second time, the cached ids of the first are out of date
+        assert f'Rows skipped as already present: {(n_old, len(reference))[i]:,}' in out
@@ -0,0 +1,36 @@
+"""Text compression dictionaries of zst.py
+
+Run with: python -m pytest tests
+"""
+
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import zst
+
+
+def test_dict_per_column():
+    conn = sqlite3.connect(':memory:')
+    assert zst.text_dict(conn, 'comments', 'body') is None
+    body = zst.train_text_dict([ f'comment {i} about the thing number {i % 17}' for i in range(2000) ], dict_size=2**12)
+    selftext = zst.train_text_dict([ f'post {i}: a question on topic {i % 13}?' for i in range(2000) ], dict_size=2**12)
+    zst.save_text_dict(conn, body, 'comments', 'body')
+    zst.save_text_dict(conn, selftext, 'submissions', 'selftext')
+    assert zst.text_dict(conn, 'comments', 'body') == body
+    assert zst.text_dict(conn, 'submissions', 'selftext') == selftext
+    assert zst.text_dict(conn, 'comments', 'selftext') is None
+    zst.register_sqlite(conn)
+    text = 'comment 5 about the thing number 5'
+    assert zst.decompress_text(zst.text_compressor(body)(text)) == text
+
+
+def test_old_dict_table():
+    """A zstd_dicts table without tbl and col gets them, and its dictionaries are not used"""
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE zstd_dicts (dict_id INTEGER PRIMARY KEY, dict BLOB, time REAL)')
+    conn.execute("INSERT INTO zstd_dicts VALUES (1, x'00', 1)")
+    assert zst.text_dict(conn, 'comments', 'body') is None
+    assert [ x[1] for x in conn.execute('PRAGMA table_info(zstd_dicts)') ][-2:] == [ 'tbl', 'col' ]
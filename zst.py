@@ -1,7 +1,11 @@
+import argparse
 from datetime import datetime
 import json
 import logging
+import os
 from pprint import pprint
+import sqlite3
+import time
 
 import zstandard
 
@@ -39,3 +43,390 @@ def read_lines_zst(file_name):
             buffer = lines[-1]
 
         reader.close()
+
+
+def read_chunks_zst(file_name, chunk_size=2**27, start_frame=0, stop_frame=None, index=None):
+    """Yield (chunk, file_bytes_processed) of raw decompressed bytes
+
+    With start_frame/stop_frame, only the lines starting within those
+    frames of the sidecar index (see index_zst) are read, so several
+    processes can read disjoint ranges of one file.  Bytes processed
+    are then counted from the start of the range.
+    """
+    offset = 0
+    offset_end = None
+    skip = 0
+    remaining = None
+    if start_frame or stop_frame is not None:
+        if index is None:
+            index = load_index(file_name)
+        if index is None:
+            raise ValueError(f"No up-to-date index for {file_name}, run: python zst.py index {file_name}")
+        frames = index['frames']
+        offset, decomp_offset, line_start, _ = frames[start_frame]
+        skip = line_start - decomp_offset
+        if stop_frame is not None and stop_frame < len(frames):
+            offset_end, _, line_end, _ = frames[stop_frame]
+        else:
+            offset_end, line_end = index['file_size'], index['decompressed_size']
+        remaining = line_end - line_start
+    with open(file_name, 'rb') as file_handle:
+        file_handle.seek(offset)
+        def tell():
+            if offset_end is None:
+                return file_handle.tell()
+            return min(file_handle.tell(), offset_end) - offset
+        reader = zstandard.ZstdDecompressor(max_window_size=2**31).stream_reader(file_handle, read_across_frames=True)
+        # Discard the tail of a line started in the previous range.
+        while skip > 0:
+            discarded = reader.read(min(skip, chunk_size))
+            if not discarded:
+                break
+            skip -= len(discarded)
+        while True:
+            chunk = reader.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk, tell()
+
+        reader.close()
+
+
+def read_line_batches_zst(file_name, chunk_size=2**27, **kwargs):
+    """Bytes mode of read_lines_zst: yield (lines, file_bytes_processed) per chunk
+
+    Lines are not decoded: each batch is the list of ``bytes`` lines
+    completed by one decompressed chunk (orjson takes bytes directly).
+    Splitting on b'\\n' is always safe in UTF-8, so multi-byte
+    characters straddling a chunk need no special handling, and only
+    the partial last line is carried over to the next chunk instead of
+    copying the whole chunk.  ``file_handle.tell()`` is called once per
+    chunk, not once per line.  Other arguments as in read_chunks_zst.
+    """
+    buffer = b''
+    file_bytes_processed = 0
+    for chunk, file_bytes_processed in read_chunks_zst(file_name, chunk_size, **kwargs):
+        lines = chunk.split(b'\n')
+        if buffer:
+            lines[0] = buffer + lines[0]
+        buffer = lines.pop()
+        yield lines, file_bytes_processed
+    # A last line without a trailing newline is still a line.
+    if buffer:
+        yield [buffer], file_bytes_processed
+
+
+def read_blocks_zst(file_name, block_bytes=2**24, chunk_size=2**27, **kwargs):
+    """Yield (parts, n_lines, file_bytes_processed) blocks of whole lines
+
+    Lines are not split at all: the parts (memoryviews into the
+    decompressed chunks, plus the one line straddling two chunks) of a
+    block concatenate to at most block_bytes of complete lines, each
+    ending in b'\\n'.  Only a single line longer than block_bytes makes a
+    bigger block.  This is for copying straight into shared memory
+    (shmring).  Other arguments as in read_chunks_zst.
+    """
+    buffer = b''
+    parts = [ ]
+    size = n_lines = 0
+    file_bytes_processed = 0
+    for chunk, file_bytes_processed in read_chunks_zst(file_name, chunk_size, **kwargs):
+        view = memoryview(chunk)
+        pos = 0
+        last = chunk.rfind(b'\n') + 1
+        if last == 0:
+            buffer += chunk
+            continue
+        if buffer:
+            pos = chunk.find(b'\n') + 1
+            line = buffer + chunk[:pos]
+            if size + len(line) > block_bytes and parts:
+                yield parts, n_lines, file_bytes_processed
+                parts, size, n_lines = [ ], 0, 0
+            parts.append(line)
+            size += len(line)
+            n_lines += 1
+        while pos < last:
+            end = min(pos + block_bytes - size, last)
+            if end < last:
+                end = chunk.rfind(b'\n', pos, end) + 1
+                if end <= pos:
+                    # The next line doesn't fit into this block
+                    if parts:
+                        yield parts, n_lines, file_bytes_processed
+                        parts, size, n_lines = [ ], 0, 0
+                        continue
+                    end = chunk.find(b'\n', pos) + 1
+            parts.append(view[pos:end])
+            size += end - pos
+            n_lines += chunk.count(b'\n', pos, end)
+            pos = end
+            if pos < last:
+                yield parts, n_lines, file_bytes_processed
+                parts, size, n_lines = [ ], 0, 0
+        buffer = chunk[last:]
+    # A last line without a trailing newline is still a line.
+    if buffer:
+        parts.append(buffer + b'\n')
+        n_lines += 1
+    if parts:
+        yield parts, n_lines, file_bytes_processed
+
+
+
+# Sidecar index of frame boundaries, for reading one file in parallel.
+#
+# Each frame is recorded as [compressed offset, decompressed offset,
+# line_start, lines_before], where line_start is the decompressed
+# offset of the first line starting at or after the frame start and
+# lines_before is the number of lines before it.  A range of frames
+# [a, b) then contains exactly the lines starting in
+# [line_start[a], line_start[b]).  Files with a single frame (like the
+# original dumps) can only be read by one process; see reframe_zst.
+
+def index_name(file_name):
+    return file_name + '.idx'
+
+
+def index_zst(file_name, read_size=2**22):
+    """Decompress file_name once, write and return its sidecar index"""
+    dctx = zstandard.ZstdDecompressor(max_window_size=2**31)
+    frames = [ ]
+    pending = [ ]      # frames whose line_start is not known yet
+    comp_pos = 0
+    decomp_pos = 0
+    lines = 0
+    at_line_start = True
+    dobj = None
+    with open(file_name, 'rb') as file_handle:
+        while data := file_handle.read(read_size):
+            while data:
+                if dobj is None:
+                    frames.append([comp_pos, decomp_pos, None, None])
+                    if at_line_start:
+                        frames[-1][2:] = [decomp_pos, lines]
+                    else:
+                        pending.append(frames[-1])
+                    dobj = dctx.decompressobj()
+                out = dobj.decompress(data)
+                if out:
+                    if pending and (i := out.find(b'\n')) >= 0:
+                        for frame in pending:
+                            frame[2:] = [decomp_pos + i + 1, lines + 1]
+                        pending = [ ]
+                    lines += out.count(b'\n')
+                    at_line_start = out.endswith(b'\n')
+                    decomp_pos += len(out)
+                if dobj.eof:
+                    comp_pos += len(data) - len(dobj.unused_data)
+                    data = dobj.unused_data
+                    dobj = None
+                else:
+                    comp_pos += len(data)
+                    data = b''
+    if not at_line_start:
+        lines += 1
+    for frame in pending:
+        frame[2:] = [decomp_pos, lines]
+    stat = os.stat(file_name)
+    index = {
+        'file_size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'decompressed_size': decomp_pos,
+        'lines': lines,
+        'frames': frames,
+        }
+    with open(index_name(file_name), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def load_index(file_name):
+    """Return the sidecar index of file_name, or None if missing or stale"""
+    try:
+        with open(index_name(file_name)) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    stat = os.stat(file_name)
+    if (index['file_size'], index['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+        log.warning(f"Stale index ignored: {index_name(file_name)}")
+        return None
+    return index
+
+
+def split_ranges(index, target_bytes):
+    """Group frames into ranges of about target_bytes compressed bytes
+
+    Returns a list of (start_frame, stop_frame, compressed_bytes).
+    """
+    frames = index['frames']
+    offsets = [ frame[0] for frame in frames ] + [ index['file_size'] ]
+    ranges = [ ]
+    start = 0
+    for i in range(1, len(frames)+1):
+        if offsets[i] - offsets[start] >= target_bytes or i == len(frames):
+            ranges.append((start, i, offsets[i] - offsets[start]))
+            start = i
+    return ranges
+
+
+def reframe_zst(file_name, out_name, frame_bytes=2**28, level=3):
+    """Recompress into independent frames of ~frame_bytes at line boundaries
+
+    Writes the sidecar index of the new file along the way, so that it
+    can be split with split_ranges without another pass.
+    """
+    cctx = zstandard.ZstdCompressor(level=level, write_content_size=True)
+    frames = [ ]
+    comp_pos = decomp_pos = lines = 0
+    pending = [ ]
+    pending_bytes = 0
+    with open(out_name, 'wb') as out:
+        def flush():
+            nonlocal comp_pos, decomp_pos, lines, pending, pending_bytes
+            data = b''.join(pending)
+            frame = cctx.compress(data)
+            out.write(frame)
+            frames.append([comp_pos, decomp_pos, decomp_pos, lines])
+            comp_pos += len(frame)
+            decomp_pos += len(data)
+            lines += data.count(b'\n')
+            pending = [ ]
+            pending_bytes = 0
+        for batch, _ in read_line_batches_zst(file_name):
+            for line in batch:
+                pending.append(line + b'\n')
+                pending_bytes += len(line) + 1
+                if pending_bytes >= frame_bytes:
+                    flush()
+        if pending:
+            flush()
+    stat = os.stat(out_name)
+    index = {
+        'file_size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'decompressed_size': decomp_pos,
+        'lines': lines,
+        'frames': frames,
+        }
+    with open(index_name(out_name), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+
+# Text columns compressed with a shared dictionary.
+#
+# Each value is its own zstd frame, which records the id of its
+# dictionary, so databases can mix dictionaries (as merged shards do).
+# The dictionaries are in the table zstd_dicts (dict_id, dict, time,
+# tbl, col): each is trained on one column (col) of one table (tbl), and
+# used for that column only.
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def train_text_dict(samples, dict_size=2**17):
+    """Train a zstd dictionary on a list of str samples, return its bytes"""
+    return zstandard.train_dictionary(dict_size, [ x.encode() for x in samples ]).as_bytes()
+
+
+def text_compressor(dict_data, level=3):
+    """Return a function str -> compressed bytes (None stays None)
+
+    dict_data None compresses without a dictionary.
+    """
+    if dict_data is not None:
+        dict_data = zstandard.ZstdCompressionDict(dict_data)
+    compress = zstandard.ZstdCompressor(level=level, dict_data=dict_data).compress
+    def compress_text(text):
+        return None if text is None else compress(text.encode())
+    return compress_text
+
+
+def create_dict_table(conn):
+    """Create the zstd_dicts table of conn, or add tbl and col to one made before they existed"""
+    conn.execute('CREATE TABLE IF NOT EXISTS zstd_dicts (dict_id INTEGER PRIMARY KEY, dict BLOB, time REAL, tbl TEXT, col TEXT)')
+    columns = { x[1] for x in conn.execute('PRAGMA table_info(zstd_dicts)') }
+    for col in ('tbl', 'col'):
+        if col not in columns:
+            conn.execute(f'ALTER TABLE zstd_dicts ADD COLUMN {col} TEXT')
+
+
+def save_text_dict(conn, dict_data, table, column):
+    """Store a dictionary trained on column of table in the zstd_dicts table of conn (not committed)"""
+    create_dict_table(conn)
+    dict_id = zstandard.ZstdCompressionDict(dict_data).dict_id()
+    conn.execute('INSERT OR IGNORE INTO zstd_dicts (dict_id, dict, time, tbl, col) VALUES (?, ?, ?, ?, ?)',
+                 (dict_id, dict_data, time.time(), table, column))
+
+
+def text_dict(conn, table, column):
+    """Return the newest dictionary of conn trained on column of table, or None"""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'zstd_dicts'").fetchone():
+        return None
+    create_dict_table(conn)
+    row = conn.execute('SELECT dict FROM zstd_dicts WHERE tbl = ? AND col = ? ORDER BY time DESC LIMIT 1',
+                       (table, column)).fetchone()
+    return row[0] if row else None
+
+
+_text_decompressors = { 0: zstandard.ZstdDecompressor() }   # dict_id: ZstdDecompressor
+def load_text_dicts(conn):
+    """Make the dictionaries of conn known to decompress_text"""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'zstd_dicts'").fetchone():
+        return
+    for dict_id, dict_data in conn.execute('SELECT dict_id, dict FROM zstd_dicts'):
+        if dict_id not in _text_decompressors:
+            _text_decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dict_data))
+
+
+def decompress_text(value):
+    """Compressed bytes -> str.  Text and None are returned as they are
+
+    Plain UTF-8 bytes are decoded, since sqlite3 converters get even
+    text values as bytes.
+    """
+    if not isinstance(value, bytes):
+        return value
+    if not value.startswith(ZSTD_MAGIC):
+        return value.decode()
+    dict_id = zstandard.get_frame_parameters(value).dict_id
+    return _text_decompressors[dict_id].decompress(value).decode()
+
+
+def register_sqlite(conn):
+    """Make the compressed text columns of an sqlite3 connection readable
+
+    Registers the SQL function zstd_decompress(x), so that
+    SELECT zstd_decompress(body) FROM comments returns text, and a
+    converter, so that columns declared ZSTD come out as str when the
+    connection was opened with detect_types=sqlite3.PARSE_DECLTYPES.
+    """
+    load_text_dicts(conn)
+    conn.create_function('zstd_decompress', 1, decompress_text, deterministic=True)
+    sqlite3.register_converter('ZSTD', decompress_text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tools for splitting .zst files for parallel reading")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_index = subparsers.add_parser('index', help="Write FILE.idx sidecar frame indexes")
+    parser_index.add_argument('files', nargs='+')
+    parser_reframe = subparsers.add_parser('reframe', help="Recompress SRC into independent frames (and index it)")
+    parser_reframe.add_argument('src')
+    parser_reframe.add_argument('dst')
+    parser_reframe.add_argument('--frame-bytes', type=int, default=2**28, help="Decompressed bytes per frame")
+    parser_reframe.add_argument('--level', type=int, default=3, help="zstd compression level")
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        for file_ in args.files:
+            index = index_zst(file_)
+            print(f"{file_}: {len(index['frames'])} frames, {index['lines']:,} lines")
+    elif args.command == 'reframe':
+        index = reframe_zst(args.src, args.dst, frame_bytes=args.frame_bytes, level=args.level)
+        print(f"{args.dst}: {len(index['frames'])} frames, {index['lines']:,} lines")